@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""
+Local archive of the 5-minute data points from the GivEnergy api.
+
+Each day is stored in its own small columnar file, so that history only
+has to be downloaded once, and can be loaded back as a set of arrays
+(one per column) without any json parsing.
+
+File layout (all little-endian):
+  magic 'GEDP', version (u16), number of columns (u16), number of rows (u32)
+  for each column: name length (u8), name, array typecode (1 char)
+  then the data for each column in turn, as packed arrays.
+
+As a script:
+  archive.py YYYY-MM-DD [YYYY-MM-DD]
+downloads any days in the range which are not already archived, and
+with no arguments, any of the last RECENT_DAYS (as the daemon does each
+night, so that planner.py has history to work from).
+"""
+
+import os
+import struct
+import sys
+from array import array
+from datetime import date, datetime, timedelta
+
+MAGIC = b'GEDP'
+VERSION = 1
+
+DEFAULT_PATH = os.path.join(os.environ.get('HOME'), '.local', 'share', 'givenergy', 'datapoints')
+
+def _epoch(t):
+    # times are UTC, as yyyy-mm-ddThh:mm:ssZ
+    return int(datetime.fromisoformat(t.replace('Z', '+00:00')).timestamp())
+
+# (name, array typecode, how to extract it from a data point)
+# Powers are in W, the 'today' totals are cumulative kWh.
+COLUMNS = (
+    ('time',              'q', lambda p: _epoch(p['time'])),
+    ('solar_power',       'i', lambda p: p['power']['solar']['power']),
+    ('grid_power',        'i', lambda p: p['power']['grid']['power']),
+    ('battery_power',     'i', lambda p: p['power']['battery']['power']),
+    ('battery_percent',   'h', lambda p: p['power']['battery']['percent']),
+    ('consumption_power', 'i', lambda p: p['power']['consumption']['power']),
+    ('today_solar',       'f', lambda p: p['today']['solar']),
+    ('today_import',      'f', lambda p: p['today']['grid']['import']),
+    ('today_export',      'f', lambda p: p['today']['grid']['export']),
+    ('today_charge',      'f', lambda p: p['today']['battery']['charge']),
+    ('today_discharge',   'f', lambda p: p['today']['battery']['discharge']),
+    ('today_consumption', 'f', lambda p: p['today']['consumption']),
+)
+
+# days kept archived by run(), enough for the planner's forecast
+RECENT_DAYS = 14
+
+def parse_day(day):
+    """accept a date, or a string as either yyyymmdd or yyyy-mm-dd"""
+    if isinstance(day, date):
+        return day
+    if len(day) == 8:
+        return datetime.strptime(day, '%Y%m%d').date()
+    return date.fromisoformat(day)
+
+class DataPointArchive:
+    """A directory of per-day data-point files"""
+
+    def __init__(self, path=None, config=None):
+        if path is None and config is not None:
+            path = config.get('archive', 'path', fallback=None)
+        if path is None:
+            path = DEFAULT_PATH
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+    def filename(self, day):
+        return os.path.join(self.path, day.isoformat() + '.gedp')
+
+    def load(self, day):
+        """return the archived columns for a day as a dict of arrays,
+        or None if the day isn't archived"""
+        try:
+            with open(self.filename(parse_day(day)), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        magic, version, ncols, nrows = struct.unpack_from('<4sHHI', data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{self.filename(day)} is not a data-points file')
+        offset = struct.calcsize('<4sHHI')
+        header = []
+        for _ in range(ncols):
+            n = data[offset]
+            name = data[offset+1:offset+1+n].decode()
+            typecode = chr(data[offset+1+n])
+            header.append((name, typecode))
+            offset += n + 2
+
+        columns = {}
+        for name, typecode in header:
+            a = array(typecode)
+            size = a.itemsize * nrows
+            a.frombytes(data[offset:offset+size])
+            if sys.byteorder != 'little':
+                a.byteswap()
+            columns[name] = a
+            offset += size
+        return columns
+
+    def save(self, day, columns):
+        """write out the columns for a day"""
+        day = parse_day(day)
+        nrows = len(columns['time'])
+        header = struct.pack('<4sHHI', MAGIC, VERSION, len(columns), nrows)
+        for name, a in columns.items():
+            header += struct.pack('<B', len(name)) + name.encode() + a.typecode.encode()
+
+        # write to a temporary file then rename, so a reader never
+        # sees a partial file
+        tmp = self.filename(day) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(header)
+            for a in columns.values():
+                if sys.byteorder != 'little':
+                    a = array(a.typecode, a)
+                    a.byteswap()
+                a.tofile(f)
+        os.replace(tmp, self.filename(day))
+
+    def fetch(self, api, day):
+        """return the columns for a day, downloading it if it isn't
+        already archived. Only complete days (before today) get saved."""
+        day = parse_day(day)
+        columns = self.load(day)
+        if columns is not None:
+            return columns
+
+        columns = { name: array(typecode) for name, typecode, _ in COLUMNS }
+        for point in api.data_points(day):
+            for name, typecode, extract in COLUMNS:
+                try:
+                    value = extract(point) or 0
+                except (KeyError, TypeError):
+                    value = 0
+                columns[name].append(float(value) if typecode == 'f' else int(value))
+
+        if day < date.today():
+            self.save(day, columns)
+        return columns
+
+def run(api):
+    """download any of the last RECENT_DAYS which aren't archived yet"""
+    archive = DataPointArchive(config=api.config)
+    today = date.today()
+    for n in range(RECENT_DAYS, 0, -1):
+        day = today - timedelta(days=n)
+        if archive.load(day) is None:
+            columns = archive.fetch(api, day)
+            print(day, len(columns['time']), 'points')
+
+def main():
+    from givenergy import GivEnergyApi
+
+    api = GivEnergyApi('archive.py')
+    if len(sys.argv) < 2:
+        run(api)
+        return
+    archive = DataPointArchive(config=api.config)
+    start = parse_day(sys.argv[1])
+    end = parse_day(sys.argv[2]) if len(sys.argv) > 2 else start
+    day = start
+    while day <= end:
+        columns = archive.fetch(api, day)
+        print(day, len(columns['time']), 'points')
+        day += timedelta(days=1)
+
+if __name__ == "__main__":
+    main()
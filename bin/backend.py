@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+"""
+The same control interface over either the cloud api or a direct
+modbus connection to the inverter on the LAN.
+
+A backend provides
+  read_setting(reg)             value of a setting
+  modify_setting(reg, value)    write a setting
+  apply_settings(settings)      write a dict of {reg: value}, skipping any already set
+  get_latest_system_data()      the current state, as a dict shaped like the
+                                api's /system-data/latest (at least ['battery']['percent'])
+where settings are identified by their numeric ids in the cloud api
+(the constants in givenergy.py), and values are as the api uses them
+(Watts, 'HH:MM', true/false, ...).
+
+GivEnergyApi is the cloud implementation. ModbusBackend talks directly
+to the inverter via givenergy-modbus, which takes milliseconds rather
+than seconds, but only knows about the settings in MODBUS_SETTINGS.
+
+connect() returns the best one available: if [givenergy] has a 'host'
+for the inverter's data logger, settings go over the LAN, falling back
+to the cloud for settings modbus doesn't know about, or when the LAN
+connection fails. Other config in [givenergy]:
+  port = 8899               modbus port on the data logger
+  battery_capacity = 9500   Wh, to convert charge/discharge power to
+                            the inverter's units (1% of capacity per hour)
+  modbus_timeout = 5        seconds allowed for each modbus operation
+"""
+
+import asyncio
+
+from givenergy import (
+    GivEnergyApi,
+    ECO_MODE,
+    DISCHARGE_START, DISCHARGE_END,
+    ENABLE_DC_DISCHARGE,
+    CHARGE_POWER, DISCHARGE_POWER,
+    CHARGE_LIMIT_1,
+    PAUSE_MODE, PAUSE_START, PAUSE_END,
+    CHARGE_START_n, CHARGE_END_n,
+    DISCHARGE_START_n, DISCHARGE_END_n,
+)
+
+# cloud setting id: (holding register, attribute of the library's
+# Inverter to read it from, how to convert the value)
+MODBUS_SETTINGS = {
+    ECO_MODE:             (27,  'eco_mode', 'bool'),
+    CHARGE_START_n[0]:    (94,  'charge_slot_1', 'start'),
+    CHARGE_END_n[0]:      (95,  'charge_slot_1', 'end'),
+    DISCHARGE_START_n[1]: (44,  'discharge_slot_2', 'start'),
+    DISCHARGE_END_n[1]:   (45,  'discharge_slot_2', 'end'),
+    DISCHARGE_START:      (56,  'discharge_slot_1', 'start'),
+    DISCHARGE_END:        (57,  'discharge_slot_1', 'end'),
+    ENABLE_DC_DISCHARGE:  (59,  'enable_discharge', 'bool'),
+    CHARGE_POWER:         (111, 'battery_charge_limit', 'power'),
+    DISCHARGE_POWER:      (112, 'battery_discharge_limit', 'power'),
+    CHARGE_LIMIT_1:       (116, 'charge_target_soc', 'int'),
+    PAUSE_MODE:           (318, 'battery_pause_mode', 'int'),
+    PAUSE_START:          (319, 'battery_pause_slot_1', 'start'),
+    PAUSE_END:            (320, 'battery_pause_slot_1', 'end'),
+}
+
+class ModbusBackend:
+    """settings over a direct modbus connection to the inverter"""
+
+    def __init__(self, host, port=8899, battery_capacity=9500, timeout=5):
+        # imported here so that the scripts don't need givenergy-modbus
+        # unless it is actually configured
+        from givenergy_modbus.client.client import Client
+        from givenergy_modbus.model.plant import Plant
+        from givenergy_modbus.model.register import HR, IR
+
+        # only the blocks that MODBUS_SETTINGS need, plus IR(0) for state
+        self.registers = {IR(0), HR(0), HR(60), HR(300)}
+        self.plant = Plant(registers=self.registers, num_batteries=0)
+        self.client = Client(host, port, plant=self.plant)
+        self.capacity = battery_capacity
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.connected = False
+        self.stale = True   # plant needs refreshing before reading
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, self.timeout))
+
+    def _refresh(self):
+        if not self.connected:
+            self._run(self.client.connect())
+            self.connected = True
+        if self.stale:
+            self._run(self.client.refresh_plant(full_refresh=True, registers=self.registers))
+            self.stale = False
+        return self.plant.inverter
+
+    def reset(self):
+        """re-read the inverter next time, rather than using what
+        was read last time, over a new connection: the data logger
+        may well have dropped this one since it was last used"""
+        self.stale = True
+        if self.connected:
+            self.connected = False
+            try:
+                self._run(self.client.close())
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f'modbus close failed: {e!r}')
+
+    # conversions between the api's values and the registers
+
+    def to_register(self, kind, value):
+        if kind == 'bool':
+            return 1 if str(value).lower() in ('true', '1', 'on') else 0
+        if kind in ('start', 'end'):
+            hh, mm = str(value).split(':')
+            return int(hh) * 100 + int(mm)
+        if kind == 'power':
+            # units are 1% of battery capacity per hour
+            return max(0, min(100, round(int(value) * 100 / self.capacity)))
+        return int(value)
+
+    def from_inverter(self, kind, value):
+        if value is None:
+            return None
+        if kind == 'bool':
+            return bool(value)
+        if kind in ('start', 'end'):
+            t = value.start if kind == 'start' else value.end
+            return t.strftime('%H:%M')
+        if kind == 'power':
+            return int(value * self.capacity / 100)
+        return int(value)
+
+    # the backend interface
+
+    def get_latest_system_data(self):
+        inverter = self._refresh()
+        return {
+            'solar': {'power': inverter.p_pv1 + inverter.p_pv2},
+            'grid': {'power': inverter.p_grid_out},
+            'battery': {'percent': inverter.battery_percent,
+                        'power': inverter.p_battery,
+                        'temperature': inverter.temp_inverter_heatsink},
+        }
+
+    def read_setting(self, reg):
+        _, attr, kind = MODBUS_SETTINGS[reg]
+        inverter = self._refresh()
+        return self.from_inverter(kind, getattr(inverter, attr))
+
+    def write_registers(self, writes):
+        """write a list of (holding register, value)"""
+        from givenergy_modbus.pdu import WriteHoldingRegisterRequest
+
+        async def execute():
+            requests = [WriteHoldingRegisterRequest(register=hr, value=value) for hr, value in writes]
+            result = self.client.execute(requests, timeout=2.0, retries=1, return_exceptions=True)
+            if asyncio.isfuture(result) or asyncio.iscoroutine(result):
+                result = await result
+            return result
+
+        self._refresh()
+        results = self._run(execute()) or ()
+        self.stale = True
+        failed = [hr for (hr, _), r in zip(writes, results) if isinstance(r, BaseException)]
+        if failed:
+            raise IOError(f'modbus write of HR {failed} failed')
+
+    def modify_setting(self, reg, value):
+        hr, _, kind = MODBUS_SETTINGS[reg]
+        print(f'modify {reg} (HR {hr}): {value}')
+        self.write_registers([(hr, self.to_register(kind, value))])
+
+    def apply_settings(self, settings):
+        writes = []
+        for reg, value in settings.items():
+            hr, _, kind = MODBUS_SETTINGS[reg]
+            raw = self.to_register(kind, value)
+            current = self.read_setting(reg)
+            # compare in the inverter's units, since eg power is
+            # only settable to the nearest 1% of capacity
+            if current is not None and self.to_register(kind, current) == raw:
+                print(f'modify {reg}: already {current}')
+                continue
+            print(f'modify {reg} (HR {hr}): {current} -> {value}')
+            writes.append((hr, raw))
+        if writes:
+            self.write_registers(writes)
+
+class FallbackBackend:
+    """modbus where possible, otherwise the cloud"""
+
+    def __init__(self, modbus, cloud):
+        self.modbus = modbus
+        self.lan = modbus
+        self.cloud = cloud
+        self.config = cloud.config
+
+    def reset(self):
+        """forget any state from previous calls, and give the LAN
+        connection another chance if it had failed"""
+        self.cloud.reset()
+        self.modbus = self.lan
+        if self.modbus is not None:
+            self.modbus.reset()
+
+    def _lan(self, what, fn, *args):
+        """try fn over modbus. Returns (True, result), or (False, None) if
+        the cloud should be used instead"""
+        if self.modbus is None:
+            return False, None
+        try:
+            return True, fn(*args)
+        except (OSError, asyncio.TimeoutError) as e:
+            # don't keep trying a connection which isn't working
+            print(f'{what} over modbus failed ({e!r}): using the cloud')
+            self.modbus = None
+            return False, None
+
+    def get_latest_system_data(self):
+        ok, result = self._lan('latest', lambda: self.modbus.get_latest_system_data())
+        return result if ok else self.cloud.get_latest_system_data()
+
+    def read_setting(self, reg):
+        if reg in MODBUS_SETTINGS:
+            ok, result = self._lan(f'read {reg}', lambda: self.modbus.read_setting(reg))
+            if ok:
+                return result
+        return self.cloud.read_setting(reg)
+
+    def modify_setting(self, reg, value):
+        if reg in MODBUS_SETTINGS:
+            ok, _ = self._lan(f'modify {reg}', lambda: self.modbus.modify_setting(reg, value))
+            if ok:
+                # the cloud's cached copy is now out of date
+                self.cloud._invalidate(f'settings/{reg!s}')
+                return
+        self.cloud.modify_setting(reg, value)
+
+    def apply_settings(self, settings):
+        lan = {reg: value for reg, value in settings.items() if reg in MODBUS_SETTINGS}
+        rest = {reg: value for reg, value in settings.items() if reg not in MODBUS_SETTINGS}
+        if lan:
+            ok, _ = self._lan('apply', lambda: self.modbus.apply_settings(lan))
+            if ok:
+                for reg in lan:
+                    self.cloud._invalidate(f'settings/{reg!s}')
+            else:
+                rest.update(lan)
+        if rest:
+            self.cloud.apply_settings(rest)
+
+def connect(context, config=None):
+    """the best backend available for the configuration in ~/.solar"""
+    cloud = GivEnergyApi(context, config)
+    config = cloud.config
+    host = config.get('givenergy', 'host', fallback=None)
+    if host is None:
+        return cloud
+    try:
+        modbus = ModbusBackend(host,
+                               config.getint('givenergy', 'port', fallback=8899),
+                               config.getfloat('givenergy', 'battery_capacity', fallback=9500),
+                               config.getfloat('givenergy', 'modbus_timeout', fallback=5))
+    except ImportError as e:
+        print(f'givenergy-modbus not available ({e}): using the cloud')
+        modbus = None
+    return FallbackBackend(modbus, cloud)
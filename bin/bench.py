@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the cron scripts against the local cloud stub (cloudstub.py).
+
+  bench.py [--latency S] [--jitter S] [--fail-rate P] [--runs N]
+
+Each script is run as a separate process (as cron would), with HOME
+pointing at a scratch directory containing a ~/.solar which directs
+everything at the stub. For each script it reports the wall time and
+the number of requests the stub saw, both with an empty cache (cold)
+and straight after a previous run (warm).
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from cloudstub import CloudStub, serve
+
+BIN = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPTS = (
+    ('offpeak',        ['givenergy-offpeak.py']),
+    ('discharge',      ['givenergy-discharge.py']),
+    ('pvoutput',       ['pvoutput.py']),
+    ('daemon o+d+p',   ['givenergy-daemon.py', 'offpeak', 'discharge', 'pvoutput']),
+    ('cli cp dp cl',   ['givenergy.py', 'cp', 'dp', 'cl']),
+    ('cli slot table', ['givenergy.py'] + [f'{x}{n}' for n in range(1, 11) for x in ('cs', 'ce', 'cl', 'ds', 'de', 'dl')]),
+    ('snapshot',       ['givenergy.py', 'snapshot', 'snapshot.json']),
+    ('restore',        ['givenergy.py', 'restore', 'snapshot.json']),
+)
+
+def write_config(home, base):
+    with open(os.path.join(home, '.solar'), 'w') as f:
+        f.write(f"""
+[givenergy]
+inverter = SA0000000
+api_token = bench
+url = {base}/v1
+# measure the scripts, not the rate limiter
+rate_limit = 100000
+
+[pvoutput]
+key = bench
+id = 1
+url = {base}/service/r2/
+
+[cache]
+path = {home}/cache.sqlite
+
+[archive]
+path = {home}/datapoints
+""")
+
+def run(home, argv):
+    """run a script, returning the wall time"""
+    env = dict(os.environ, HOME=home)
+    t0 = time.perf_counter()
+    result = subprocess.run([sys.executable] + [os.path.join(BIN, argv[0])] + argv[1:],
+                            cwd=home, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - t0
+    if result.returncode != 0:
+        print(f'{argv[0]} failed:\n{result.stderr.decode()}')
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the scripts against the cloud stub')
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--fail-rate', type=float, default=0.05)
+    parser.add_argument('--runs', type=int, default=3, help='runs of each script')
+    args = parser.parse_args()
+
+    stub = CloudStub(args.latency, args.jitter, args.fail_rate)
+    server = serve(stub)
+    home = tempfile.mkdtemp(prefix='bench')
+    try:
+        write_config(home, stub.base)
+        print(f'latency {args.latency}s +/- {args.jitter}s, fail rate {args.fail_rate:.0%}')
+        print(f"{'script':16s} {'cold (s)':>9s} {'reqs':>5s} {'warm (s)':>9s} {'reqs':>5s}")
+        for label, argv in SCRIPTS:
+            cold = warm = 0.0
+            cold_reqs = warm_reqs = 0
+            for _ in range(args.runs):
+                cache = os.path.join(home, 'cache.sqlite')
+                if os.path.exists(cache):
+                    os.remove(cache)
+                stub.stats.clear()
+                cold += run(home, argv)
+                cold_reqs += stub.stats['total']
+                stub.stats.clear()
+                warm += run(home, argv)
+                warm_reqs += stub.stats['total']
+            n = args.runs
+            print(f'{label:16s} {cold/n:9.2f} {cold_reqs/n:5.1f} {warm/n:9.2f} {warm_reqs/n:5.1f}')
+    finally:
+        server.shutdown()
+        shutil.rmtree(home)
+
+if __name__ == "__main__":
+    main()
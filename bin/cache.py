@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+A small persistent key/value cache with a per-key expiry time,
+shared between all the scripts (and between concurrent invocations
+of them). It's just a sqlite database - sqlite takes care of the
+file-locking, so a cron job and a manual invocation can safely
+update it at the same time.
+
+Values are stored as json.
+
+It also holds token buckets, so that all the scripts can share a
+rate limit on the requests they make.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+DEFAULT_PATH = os.path.join(os.environ.get('HOME'), '.cache', 'givenergy', 'cache.sqlite')
+
+class Cache:
+    """Persistent TTL cache"""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = DEFAULT_PATH
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS cache '
+                       '(key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS buckets '
+                       '(key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+
+    def _connect(self):
+        # A new connection for each operation: it's cheap, and means
+        # the cache can be used from worker threads too.
+        # The timeout is how long to wait for another process to
+        # release its lock.
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        return closing(db)
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+        with self._connect() as db:
+            row = db.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, value, ttl):
+        """Store a value, which expires after ttl seconds"""
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                       (key, json.dumps(value), time.time() + ttl))
+
+    def delete(self, key):
+        """Invalidate a key"""
+        with self._connect() as db:
+            db.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def take(self, key, rate, burst):
+        """Take a token from the bucket key, which refills at rate tokens
+        per second, up to burst. Returns 0 if a token was taken, else
+        how long (seconds) until one will be available."""
+        now = time.time()
+        with self._connect() as db:
+            # take the write lock up front, so that the read-modify-write
+            # is atomic with respect to other processes
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                wait = 0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', (key, tokens, now))
+            finally:
+                db.execute('COMMIT')
+        return wait
+
+    def purge(self):
+        """Discard all expired entries"""
+        with self._connect() as db:
+            db.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+
+if __name__ == "__main__":
+    # just tidy up
+    Cache().purge()
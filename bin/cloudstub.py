@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+"""
+A local stand-in for the GivEnergy cloud api (and the bits of pvoutput.org
+we use), for testing and benchmarking the scripts without the real thing.
+
+  cloudstub.py [--port N] [--latency S] [--jitter S] [--fail-rate P]
+
+Point the scripts at it by adding to ~/.solar
+  [givenergy]
+  url = http://localhost:N/v1
+and for pvoutput
+  [pvoutput]
+  url = http://localhost:N/service/r2/
+
+It keeps a simple model of the inverter's registers, so writes stick and
+later reads see them. Every request is delayed by latency (+/- jitter),
+and fails with probability fail-rate, in one of the ways the real thing
+does: an http 5xx, a -ve error code from a settings read, or
+success: false from a settings write.
+
+GET /stats returns the number of requests handled, by endpoint, and
+POST /stats/reset clears them.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from givenergy import (
+    CHARGE_START_n, CHARGE_END_n, CHARGE_LIMIT_n,
+    DISCHARGE_START_n, DISCHARGE_END_n, DISCHARGE_LIMIT_n,
+    ECO_MODE, CHARGE_POWER, DISCHARGE_POWER, CHARGE_LIMIT,
+    PAUSE_MODE, PAUSE_START, PAUSE_END, ENABLE_DC_DISCHARGE,
+)
+
+def initial_registers():
+    """the register model: {id: (name, validation, value)}"""
+    regs = {}
+    for idx in range(10):
+        regs[CHARGE_START_n[idx]] = (f'AC Charge {idx+1} Start Time', 'Value format should be HH:mm', '00:00')
+        regs[CHARGE_END_n[idx]] = (f'AC Charge {idx+1} End Time', 'Value format should be HH:mm', '00:00')
+        regs[CHARGE_LIMIT_n[idx]] = (f'AC Charge {idx+1} Upper SOC % Limit', 'Value must be between 0 and 100', 100)
+        regs[DISCHARGE_START_n[idx]] = (f'DC Discharge {idx+1} Start Time', 'Value format should be HH:mm', '00:00')
+        regs[DISCHARGE_END_n[idx]] = (f'DC Discharge {idx+1} End Time', 'Value format should be HH:mm', '00:00')
+        regs[DISCHARGE_LIMIT_n[idx]] = (f'DC Discharge {idx+1} Lower SOC % Limit', 'Value must be between 4 and 100', 4)
+    regs[ECO_MODE] = ('Eco Mode', 'Value must be one of: true, false', True)
+    regs[ENABLE_DC_DISCHARGE] = ('Enable DC Discharge', 'Value must be one of: true, false', False)
+    regs[CHARGE_POWER] = ('Battery Charge Power', 'Value must be between 0 and 3600', 2600)
+    regs[DISCHARGE_POWER] = ('Battery Discharge Power', 'Value must be between 0 and 3600', 2600)
+    regs[CHARGE_LIMIT] = ('AC Charge Upper % Limit', 'Value must be between 0 and 100', 100)
+    regs[PAUSE_MODE] = ('Pause Battery', 'Value must be one of: 0, 1, 2, 3', 0)
+    regs[PAUSE_START] = ('Pause Battery Start Time', 'Value format should be HH:mm', '05:30')
+    regs[PAUSE_END] = ('Pause Battery End Time', 'Value format should be HH:mm', '19:55')
+    return regs
+
+def convert(old, value):
+    """convert a written string to the type of the existing value"""
+    if isinstance(old, bool):
+        return value.lower() in ('true', '1', 'on')
+    if isinstance(old, int):
+        return int(value)
+    return value
+
+def data_points(day):
+    """a made-up day of 5-minute data points"""
+    points = []
+    totals = Counter()
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    for i in range(288):
+        t = start + timedelta(minutes=5*i)
+        hour = i / 12
+        solar = max(0, int(5000 * (1 - ((hour - 13) / 6) ** 2)))
+        load = 400 + (2000 if 17 <= hour < 19 else 0)
+        grid = solar - load       # +ve is export
+        totals['solar'] += solar / 12000
+        totals['import' if grid < 0 else 'export'] += abs(grid) / 12000
+        totals['consumption'] += load / 12000
+        points.append({
+            'time': t.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'status': 'Normal',
+            'power': {
+                'solar': {'power': solar, 'arrays': []},
+                'grid': {'power': grid},
+                'battery': {'percent': 50, 'power': 0, 'temperature': 20},
+                'consumption': {'power': load},
+            },
+            'today': {
+                'solar': round(totals['solar'], 1),
+                'grid': {'import': round(totals['import'], 1), 'export': round(totals['export'], 1)},
+                'battery': {'charge': 0, 'discharge': 0},
+                'consumption': round(totals['consumption'], 1),
+                'ac_charge': 0,
+            },
+        })
+    return points
+
+class CloudStub:
+    """the state shared between the request handlers"""
+
+    def __init__(self, latency=0.0, jitter=0.0, fail_rate=0.0, battery_percent=40):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.battery_percent = battery_percent
+        self.registers = initial_registers()
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        t = self.latency + random.uniform(-self.jitter, self.jitter)
+        if t > 0:
+            time.sleep(t)
+
+    def fail(self):
+        return random.random() < self.fail_rate
+
+    def count(self, endpoint):
+        with self.lock:
+            self.stats[endpoint] += 1
+            self.stats['total'] += 1
+
+    def handle(self, method, path, query, body):
+        """returns (status, headers, body)"""
+        if path == '/stats':
+            with self.lock:
+                return 200, {}, dict(self.stats)
+        if path == '/stats/reset' and method == 'POST':
+            with self.lock:
+                self.stats.clear()
+            return 200, {}, {}
+
+        m = re.fullmatch(r'/service/r2/(\w+)\.jsp', path)
+        if m:
+            self.count(m.group(1))
+            self.delay()
+            reset = int(time.time()) + 3600
+            return 200, {'X-Rate-Limit-Remaining': '59', 'X-Rate-Limit-Reset': str(reset)}, 'OK 200: Added Output'
+
+        m = re.fullmatch(r'/v1/inverter/(\w+)(/.*)', path)
+        if not m:
+            return 404, {}, {'message': 'not found'}
+        serial, endpoint = m.groups()
+        self.count(re.sub(r'/\d[\d-]*', '/{n}', endpoint))
+        self.delay()
+        if self.fail() and random.random() < 0.3:
+            return 503, {}, {'message': 'Service Unavailable'}
+
+        if endpoint == '/settings' and method == 'GET':
+            return 200, {}, {'data': [{'id': id, 'name': name, 'validation': validation}
+                                      for id, (name, validation, _) in sorted(self.registers.items())]}
+        if endpoint == '/presets' and method == 'GET':
+            return 200, {}, {'data': []}
+        if endpoint == '/system-data/latest':
+            return 200, {}, {'data': {'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                      'battery': {'percent': self.battery_percent, 'power': 0, 'temperature': 20}}}
+        if endpoint == '/meter-data/latest':
+            points = data_points(date.today())
+            return 200, {}, {'data': {'time': points[-1]['time'], 'today': points[-1]['today']}}
+
+        m = re.fullmatch(r'/data-points/(\d{4}-\d\d-\d\d)', endpoint)
+        if m:
+            points = data_points(date.fromisoformat(m.group(1)))
+            size = int(query.get('pageSize', ['15'])[0])
+            page = int(query.get('page', ['1'])[0])
+            data = points[(page-1)*size:page*size]
+            next = None
+            if page * size < len(points):
+                next = f'{self.base}/v1/inverter/{serial}{endpoint}?page={page+1}&pageSize={size}'
+            return 200, {}, {'data': data, 'links': {'next': next}, 'meta': {'current_page': page}}
+
+        m = re.fullmatch(r'/settings/(\d+)/(read|write)', endpoint)
+        if m and method == 'POST':
+            reg = int(m.group(1))
+            if reg not in self.registers:
+                return 404, {}, {'message': 'setting not found'}
+            name, validation, value = self.registers[reg]
+            if m.group(2) == 'read':
+                if self.fail():
+                    return 200, {}, {'data': {'value': random.choice((-1, -2, -3))}}
+                return 200, {}, {'data': {'value': value}}
+            if self.fail():
+                return 200, {}, {'data': {'value': body.get('value'), 'success': False, 'message': 'Timed Out'}}
+            with self.lock:
+                self.registers[reg] = (name, validation, convert(value, body['value']))
+            return 200, {}, {'data': {'value': body['value'], 'success': True, 'message': 'Written Successfully'}}
+
+        return 404, {}, {'message': 'not found'}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, like the real thing
+
+    def do(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length) if length else b''
+        body = {}
+        if raw and 'json' in self.headers.get('Content-Type', ''):
+            body = json.loads(raw)
+        status, headers, reply = self.server.stub.handle(method, url.path, parse_qs(url.query), body)
+        data = (reply if isinstance(reply, str) else json.dumps(reply)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain' if isinstance(reply, str) else 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.do('GET')
+
+    def do_POST(self):
+        self.do('POST')
+
+    def log_message(self, format, *args):
+        pass    # too noisy
+
+def serve(stub, port=0):
+    """start the server in a background thread. Returns the server, whose
+    server_address gives the actual port"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.stub = stub
+    stub.base = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='local stand-in for the GivEnergy cloud api')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +/- variation in latency')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='probability of a request failing')
+    args = parser.parse_args()
+
+    server = serve(CloudStub(args.latency, args.jitter, args.fail_rate), args.port)
+    print(f'listening on {server.stub.base}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
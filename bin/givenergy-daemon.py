@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+  givenergy-daemon.py           run the jobs on their schedules
+  givenergy-daemon.py JOB...    run the given jobs once, now
+
+Runs the cron jobs (givenergy-offpeak.py, givenergy-discharge.py,
+givenergy-iog.py, pvoutput.py) from one long-running process, so that
+config, connections to the cloud, octopus and pvoutput, and the cache
+are set up once rather than for every job.
+
+Each job is a script in bin/ with a run(api) function, which does what
+the script would do when run from cron with no arguments. api is the
+shared backend (see backend.py). If run() also has 'iog', 'pvoutput' or
+'charging' parameters, it is given the shared octopus / pvoutput clients
+or the latest charging slots.
+
+Schedules come from an optional [daemon] section in ~/.solar, one line
+per job, as either a cron-style 'minute hour day month weekday'
+(supporting *, */n, a-b and lists), or 'dispatch' to run whenever the
+IOG dispatches change. The script for job NAME is givenergy-NAME.py,
+or NAME.py. eg the defaults are equivalent to
+  [daemon]
+  discharge = 0 20 * * *
+  offpeak = 25 23 * * *
+  iog = dispatch
+  pvoutput = 30 21 * * *
+  archive = 15 1 * * *
+  iog_poll = 10
+
+iog_poll is how often (minutes) to check for new dispatches, if any
+job runs on 'dispatch'.
+
+Jobs are run one at a time, in a worker thread, so a slow job doesn't
+hold up the schedule.
+"""
+
+import asyncio
+import importlib.util
+import inspect
+import os
+import sys
+import traceback
+from datetime import datetime, timedelta
+
+from backend import connect
+
+BIN = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_JOBS = {
+    'discharge': '0 20 * * *',
+    'offpeak': '25 23 * * *',
+    'iog': 'dispatch',
+    'pvoutput': '30 21 * * *',
+    'archive': '15 1 * * *',
+}
+
+# options in [daemon] which are not jobs
+OPTIONS = ('iog_poll',)
+
+class Cron:
+    """a cron-style schedule: minute hour day month weekday"""
+
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f'bad schedule {spec!r}: expected 5 fields')
+        self.spec = spec
+        self.fields = [self.parse(f, lo, hi) for f, (lo, hi) in zip(fields, self.RANGES)]
+
+    @staticmethod
+    def parse(field, lo, hi):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            step = int(step) if step else 1
+            if part == '*':
+                start, end = lo, hi
+            elif '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = end = int(part)
+            values.update(range(start, end + 1, step))
+        return values
+
+    def matches(self, t):
+        # cron counts weekdays from sunday = 0
+        values = (t.minute, t.hour, t.day, t.month, (t.weekday() + 1) % 7)
+        return all(v in f for v, f in zip(values, self.fields))
+
+def load_job(name):
+    """import the script for a job, and return its run function"""
+    for filename in (f'givenergy-{name}.py', f'{name}.py'):
+        path = os.path.join(BIN, filename)
+        if os.path.exists(path):
+            spec = importlib.util.spec_from_file_location(filename[:-3].replace('-', '_'), path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            return module.run
+    raise ValueError(f'no script for job {name}')
+
+class Daemon:
+    def __init__(self):
+        self.api = connect('givenergy-daemon')
+        self.config = self.api.config
+        # pvoutput and archive need the cloud itself
+        self.cloud = getattr(self.api, 'cloud', self.api)
+
+        jobs = DEFAULT_JOBS
+        if self.config.has_section('daemon'):
+            jobs = {name: spec for name, spec in self.config['daemon'].items() if name not in OPTIONS}
+        self.jobs = {}
+        self.triggered = []
+        for name, spec in jobs.items():
+            run = load_job(name)
+            if spec.strip() == 'dispatch':
+                self.triggered.append(name)
+            else:
+                self.jobs[name] = (Cron(spec), run)
+            self.jobs.setdefault(name, (None, run))
+        self.poll = self.config.getfloat('daemon', 'iog_poll', fallback=10) * 60
+
+        # shared clients, made on first use
+        self.shared = {}
+        self.lock = asyncio.Lock()
+        # the event loop only keeps weak references to tasks, so the
+        # scheduled jobs are kept here until they finish
+        self.tasks = set()
+
+    def client(self, name):
+        if name not in self.shared:
+            if name == 'iog':
+                from octopus import IOG
+                self.shared[name] = IOG(self.config)
+            elif name == 'pvoutput':
+                from pvoutput import PVOutput
+                self.shared[name] = PVOutput(self.config['pvoutput'])
+        return self.shared[name]
+
+    async def run(self, name, **extra):
+        """run a job in a worker thread, one at a time. Returns
+        whether it succeeded."""
+        if name not in self.jobs:
+            self.jobs[name] = (None, load_job(name))
+        _, run = self.jobs[name]
+        params = inspect.signature(run).parameters
+        api = self.cloud if name in ('pvoutput', 'archive') else self.api
+        kwargs = {k: self.client(k) for k in ('iog', 'pvoutput') if k in params}
+        kwargs.update({k: v for k, v in extra.items() if k in params})
+        async with self.lock:
+            print(f'{name} :', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            self.api.reset()
+            ok = True
+            try:
+                await asyncio.to_thread(run, api, **kwargs)
+            except Exception:
+                # one failed job shouldn't stop the others
+                traceback.print_exc()
+                ok = False
+            sys.stdout.flush()
+            return ok
+
+    async def schedule(self):
+        """run the cron jobs as their times come round"""
+        while True:
+            now = datetime.now()
+            next = (now + timedelta(minutes=1)).replace(second=0, microsecond=0)
+            await asyncio.sleep((next - now).total_seconds())
+            for name, (cron, _) in self.jobs.items():
+                if cron is not None and cron.matches(next):
+                    task = asyncio.create_task(self.run(name))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+
+    async def dispatches(self):
+        """poll for IOG dispatches, and run the triggered jobs when they change"""
+        iog = self.client('iog')
+        store = iog.dispatchStore('daemon')
+        first = store.empty
+        while True:
+            try:
+                charging = await asyncio.to_thread(iog.chargingSlots)
+                ok = True
+                if first or any(store.changes(charging)):
+                    for name in self.triggered:
+                        ok = await self.run(name, charging=charging) and ok
+                if ok:
+                    first = False
+                    store.update(charging)
+                else:
+                    # leave the store as it was, so that the next
+                    # poll sees the change and tries again
+                    print('not recording the charging slots, since a job failed')
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(self.poll)
+
+    async def main(self):
+        for name, (cron, _) in sorted(self.jobs.items()):
+            print(f'{name:10s} {cron.spec if cron else "on dispatch"}')
+        tasks = [self.schedule()]
+        if self.triggered:
+            tasks.append(self.dispatches())
+        await asyncio.gather(*tasks)
+
+def main():
+    if len(sys.argv) > 1:
+        # run the named jobs once, now - handy for checking the setup
+        daemon = Daemon()
+        async def once():
+            for name in sys.argv[1:]:
+                await daemon.run(name)
+        asyncio.run(once())
+        return
+    asyncio.run(Daemon().main())
+
+if __name__ == "__main__":
+    main()
@@ -2,21 +2,24 @@
 
 # this runs around 5am to check for any car-charging activity.
 # It sets the pause-start time to be after the last charging slot.
+#
+# With --poll MINS it keeps checking every few minutes, but only
+# touches the inverter when the charging slots actually change.
 
 import os
+import sys
 import datetime
 
 from givenergy import GivEnergyApi, PAUSE_START
 from octopus import IOG
+from sensors import SensorWriter, sensors_path
 
-def main():
-    givenergy = GivEnergyApi('iog')
-    
-    charging = IOG.getChargingSlots(givenergy.config)
+def pause_start(charging):
+    """work out the pause start time from the charging slots"""
 
     # assume 5:30 by default
     start = datetime.time(5, 30)
-    
+
     # because they're sorted, only need to worry about
     # the last slot, and only if it's not complete
     if len(charging) > 0 and not charging[-1][3]:
@@ -24,10 +27,43 @@ def main():
         if start < endslot:
             start = endslot
 
+    return f'{start.hour:02d}:{start.minute:02d}'
+
+def run(api, iog=None, charging=None):
+    """set the pause start time from the charging slots (fetching
+    them if not supplied). Returns the slots."""
+    if charging is None:
+        if iog is None:
+            iog = IOG(api.config)
+        charging = iog.chargingSlots()
+    SensorWriter(sensors_path(api.config)).set_dispatches(charging)
+
     # Now we have our pause time
-    pause = f'{start.hour:02d}:{start.minute:02d}'
+    pause = pause_start(charging)
     # print("setting pause start time to ", pause)
-    givenergy.modify_setting(PAUSE_START, pause)
+    api.apply_settings({ PAUSE_START: pause })
+    return charging
+
+def main():
+    givenergy = GivEnergyApi('iog')
+    iog = IOG(givenergy.config)
+    store = iog.dispatchStore('iog')
+    first = store.empty
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--poll':
+        polling = iog.poll(float(sys.argv[2]) * 60)
+    else:
+        polling = [iog.chargingSlots()]
+
+    for charging in polling:
+        if not first and not any(store.changes(charging)):
+            print('no change to charging slots')
+            continue
+        run(givenergy, iog, charging)
+        # only now the inverter has been updated, so that if it
+        # failed, the next run tries again
+        store.update(charging)
+        first = False
 
 if __name__ == "__main__":
     main()
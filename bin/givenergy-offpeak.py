@@ -7,40 +7,39 @@ and chooses an appropriate charge rate to spread the
 charge over the whole offpeak period
 """
 
-from givenergy import (
-    GivEnergyApi,
-    CHARGE_POWER,
-    CHARGE_LIMIT_2,
-)
+from backend import connect
+from givenergy import CHARGE_LIMIT_n
+from planner import Planner, charge_writes, describe
 
 
-def main():
+def run(api):
     """calculate required charging power"""
-    api = GivEnergyApi('offpeak.py')
-
     latest = api.get_latest_system_data()
     current = latest['battery']['percent']
-    target = api.read_setting(CHARGE_LIMIT_2)
-    delta = target - current
+    planner = Planner(api.config)
+    target = api.read_setting(CHARGE_LIMIT_n[planner.charge_slot - 1])
 
     # While I have 6 hours offpeak from 2330 to 0530, because the
     # cumulative metering for battery in/out seems broken, I want
     # to delay the charging until after the daily counters get
     # reset at midnight. Also, allowing battery to idle at low SoC
-    # may rebalance it. So charging is for 5 hours from 0030 to 0530.
+    # may rebalance it. So charging is for 5 hours from 0030 to 0530,
+    # as set up in slot 2 (and the planner's default window). The slot
+    # is only rewritten if [planner] charge says otherwise.
 
-    # battery is 9.5kWh - round up to 10000 for convenience
-    # => want (delta / 100) * 10000Wh / 5h = delta * 20 (Watts)
-    # Arbitrarily choose min charge rate of 500W which will
-    # deliver 2.5kWh, or 25%, in 5 hours.
-    # Note also that inverter tends to add about 180W over set rate anyway.
-    # if target is over 95% we'll need higher power to compensate for slowdown
-    charge = 500 if delta <= 25 else delta * 22 if target >= 95 else delta * 20
+    # The planner works out the lowest rate which gets to the target
+    # by the end, given what the house will draw overnight, and sizes
+    # the setting from how the battery actually responds (it charges
+    # somewhat over the set rate - see response.py).
+    plan = planner.plan_charge(current, target)
 
-    print(f'Current={current}, target={target} => charge={charge}')
+    print(f'Current={current}, target={target} => {describe(plan)}')
 
-    api.modify_setting(CHARGE_POWER, value=charge)
+    api.apply_settings(charge_writes(plan, planner.charge_slot, planner.charge_configured))
 
+def main():
+    # over the LAN if possible, else the cloud
+    run(connect('offpeak.py'))
 
 if __name__ == "__main__":
     main()
@@ -2,16 +2,29 @@
 
 """
 Wrapper around requests for the GivEnergy API.
-implements connection pooling and retries
+implements connection pooling and retries, within a rate limit
+shared by all the scripts, and an overall deadline for each call.
+
+requests is only imported (and the session set up) when a request
+actually has to be made, since that takes a noticeable time on a Pi,
+and plenty of invocations can be satisfied from the cache. Likewise
+asyncio, subprocess and concurrent.futures, which are only needed for
+requests, or a background refresh.
+
+AsyncGivEnergyApi provides the same operations for asyncio code.
 """
 
 import configparser
+import itertools
+import json
 import os
+import re
+import threading
 import time
 import sys
 from datetime import datetime
-from requests import Session
-from requests.adapters import HTTPAdapter, Retry
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+from cache import Cache
 
 ECO_MODE=24
 DISCHARGE_START=53
@@ -33,6 +46,49 @@ DISCHARGE_START_n= (53, 41,131,134,137,140,143,146,149,152)
 DISCHARGE_END_n=   (54, 42,132,135,138,141,144,147,150,153)
 DISCHARGE_LIMIT_n=(129,130,133,136,139,142,145,148,151,154)
 
+# short names for settings, as used on the command line
+NAMES = { 'cp': CHARGE_POWER,
+          'dp': DISCHARGE_POWER,
+          'cl': CHARGE_LIMIT,
+          'pt': PAUSE_MODE,
+          'ps': PAUSE_START,
+          'pe': PAUSE_END,
+          'ds': DISCHARGE_START,
+          'de': DISCHARGE_END,
+          'ed': ENABLE_DC_DISCHARGE,
+          'eco': ECO_MODE,
+          }
+
+# add numbered charge and discharge slots
+for idx in range(1,11):
+    NAMES[f'cs{idx}'] = CHARGE_START_n[idx-1]
+    NAMES[f'ce{idx}'] = CHARGE_END_n[idx-1]
+    NAMES[f'cl{idx}'] = CHARGE_LIMIT_n[idx-1]
+    NAMES[f'ds{idx}'] = DISCHARGE_START_n[idx-1]
+    NAMES[f'de{idx}'] = DISCHARGE_END_n[idx-1]
+    NAMES[f'dl{idx}'] = DISCHARGE_LIMIT_n[idx-1]
+
+# The table of settings and presets (with their validation rules) is
+# kept in the cache for TABLE_TTL, and refreshed in the background when
+# it is older than TABLE_REFRESH. Bump TABLE_VERSION if its format changes.
+TABLE_VERSION = 1
+TABLE_TTL = 30 * 86400
+TABLE_REFRESH = 86400
+
+# everything saved by 'givenergy.py snapshot'
+SNAPSHOT_SETTINGS = tuple(dict.fromkeys(
+    CHARGE_START_n + CHARGE_END_n + CHARGE_LIMIT_n +
+    DISCHARGE_START_n + DISCHARGE_END_n + DISCHARGE_LIMIT_n +
+    (PAUSE_MODE, PAUSE_START, PAUSE_END, ECO_MODE,
+     CHARGE_POWER, DISCHARGE_POWER, ENABLE_DC_DISCHARGE)))
+
+# settings which act on the slots, so restore() writes them last
+SNAPSHOT_ENABLES = (ENABLE_DC_DISCHARGE, PAUSE_MODE)
+
+# max number of concurrent requests (and pooled connections)
+# used by read_settings() and apply_settings()
+POOL_SIZE = 8
+
 
 #
 # Config is read from ~/.solar - expects a [givenergy] section, which includes
@@ -41,6 +97,93 @@ DISCHARGE_LIMIT_n=(129,130,133,136,139,142,145,148,151,154)
 # Will load whatever else is there and make it available via config field
 # (currently a [pvoutput] section)
 
+# An optional [cache] section controls the cache of settings reads and
+# system data shared between scripts:
+#   enabled = no  to disable it altogether
+#   path = ...    location of the cache file
+#   settings_ttl, latest_ttl  lifetimes of cached values, in seconds
+
+# Requests are limited to rate_limit per minute (default 300), with bursts of
+# up to 'burst' (default 20), across all the scripts using the same cache.
+# Each read or write gives up after 'deadline' seconds (default 300),
+# and each http request after 'timeout' (default 30). All in [givenergy].
+
+class RateLimiter:
+    """token bucket. Shared between processes through the cache if
+    there is one, else just within this process."""
+
+    def __init__(self, cache, key, rate, burst):
+        self.cache = cache
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = time.time()
+
+    def delay(self):
+        """take a token if there is one (returning 0), else return
+        how long to wait before trying again"""
+        if self.cache is not None:
+            return self.cache.take(self.key, self.rate, self.burst)
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def wait(self):
+        """block until a token is available"""
+        while (delay := self.delay()) > 0:
+            time.sleep(delay)
+
+class SingleFlight:
+    """coalesce identical concurrent calls: while a call for some key
+    is in progress, other threads asking for the same key wait for
+    its result rather than making their own request"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        from concurrent.futures import Future
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+def with_params(url, params):
+    """url, plus any of params (as from parse_qs) which it doesn't
+    already have in its query"""
+    parts = urlsplit(url)
+    query = parse_qs(parts.query)
+    missing = {k: v for k, v in params.items() if k not in query}
+    if not missing:
+        return url
+    query.update(missing)
+    return urlunsplit(parts._replace(query=urlencode(query, doseq=True)))
+
+def time_left(end):
+    """seconds until a deadline (from time.monotonic())"""
+    return end - time.monotonic()
+
 class GivEnergyApi:
     """A wrapper around requests for GivEnergy api"""
 
@@ -51,18 +194,29 @@ class GivEnergyApi:
 
         self.config = config
         self.context = context
-        self.url = "https://api.givenergy.cloud/v1/inverter/" + config['givenergy']['inverter']
+        base = config.get('givenergy', 'url', fallback="https://api.givenergy.cloud/v1")
+        self.url = base + "/inverter/" + config['givenergy']['inverter']
 
-        session = Session()
-        session.headers.update({'Authorization': 'Bearer ' + config['givenergy']['api_token'],
-                                'Content-Type': 'application/json',
-                                'Accept': 'application/json'})
-        retries = Retry(total=10, backoff_factor=5, allowed_methods=None)  # None means all
-        session.mount(self.url, HTTPAdapter(max_retries=retries))
-        self.session = session
+        self._session = None
+        self.session_lock = threading.Lock()
+        self.timeout = config.getfloat('givenergy', 'timeout', fallback=30)
+        self.deadline = config.getfloat('givenergy', 'deadline', fallback=300)
+        self.flights = SingleFlight()
 
         self.latest = None  # cache of system data
 
+        # persistent cache, shared with other scripts
+        self.cache = None
+        if config.getboolean('cache', 'enabled', fallback=True):
+            self.cache = Cache(config.get('cache', 'path', fallback=None))
+        self.settings_ttl = config.getfloat('cache', 'settings_ttl', fallback=300)
+        self.latest_ttl = config.getfloat('cache', 'latest_ttl', fallback=60)
+        self.cache_prefix = config['givenergy']['inverter'] + '/'
+
+        self.limiter = RateLimiter(self.cache, 'ratelimit/givenergy',
+                                   config.getfloat('givenergy', 'rate_limit', fallback=300) / 60,
+                                   config.getfloat('givenergy', 'burst', fallback=20))
+
         # doesn't really belong here, but since I have
         # most scripts redirecting stdout to a logfile,
         # it is useful.
@@ -72,113 +226,583 @@ class GivEnergyApi:
 
     # low-level stuff
 
+    @property
+    def session(self):
+        """the requests Session, created on first use"""
+        with self.session_lock:
+            if self._session is None:
+                from requests.adapters import Retry
+                # retries are done by request(), within the deadline,
+                # rather than sleeping inside urllib3
+                self._session = self.make_session(Retry(0), POOL_SIZE)
+            return self._session
+
+    def make_session(self, retries, pool_size):
+        """create a requests Session for talking to the api"""
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        session = Session()
+        session.headers.update({'Authorization': 'Bearer ' + self.config['givenergy']['api_token'],
+                                'Content-Type': 'application/json',
+                                'Accept': 'application/json'})
+        session.mount(self.url, HTTPAdapter(max_retries=retries, pool_maxsize=pool_size))
+        return session
+
+    def request(self, method, url, end=None, **kwargs):
+        """perform a request on the api, within the rate limit, retrying
+        on network errors and server errors until the deadline end (from
+        time.monotonic(), by default 'deadline' seconds from now). url
+        is absolute."""
+        from requests import RequestException
+        if end is None:
+            end = time.monotonic() + self.deadline
+        delay = 2
+        for attempt in range(10):
+            timeout = min(self.timeout, time_left(end))
+            if timeout <= 0:
+                raise IOError(f'{method} {url}: deadline exceeded')
+            self.limiter.wait()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    return response.json()
+                print(f'{method} {url} got {response.status_code}: retrying')
+            except RequestException as e:
+                if getattr(e, 'response', None) is not None:
+                    raise   # a 4xx from raise_for_status()
+                print(f'{method} {url} failed ({e!r}): retrying')
+            self._backoff(end, delay, f'{method} {url}')
+            delay = delay * 2
+        raise IOError(f'too many attempts to {method} {url}')
+
     def get(self, url):
-        """perform a GET operation on the api"""
-        response = self.session.request('GET', self.url + url)
-        response.raise_for_status()
-        return response.json()['data']
+        """perform a GET operation on the api. Concurrent GETs of the
+        same url share one request."""
+        return self.flights.do('GET ' + url, lambda: self.request('GET', self.url + url)['data'])
 
-    def post(self, url, payload=None, value=None):
+    def get_pages(self, url):
+        """generator which performs a GET on a paginated endpoint, and
+        yields the data from each page in turn, following the 'next'
+        links only as the caller asks for more. Parameters of the first
+        request (eg pageSize) are added to the next links if they leave
+        them out, so that every page is the same size."""
+        url = self.url + url
+        params = parse_qs(urlsplit(url).query)
+        while url:
+            json = self.request('GET', url)
+            yield json['data']
+            url = (json.get('links') or {}).get('next')
+            if url:
+                url = with_params(url, params)
+
+    def post(self, url, payload=None, value=None, end=None):
         """perform a POST operation on the api"""
         if payload is None:
             payload={ 'context': self.context }
         if value is not None:
             payload['value'] = str(value)
-        response = self.session.request('POST', self.url + url, json=payload)
-        response.raise_for_status()
         # TODO: perhaps look for the 'remote control codes' (offline, timeout, etc)
         # Or does that come back as http code 400 ?
-        return response.json()['data']
+        return self.request('POST', self.url + url, end, json=payload)['data']
 
     # higher level stuff
 
     def get_latest_system_data(self):
         """fetch /system-data/latest as a dictionary. Cached between calls."""
         if not self.latest:
-            self.latest = self.get("/system-data/latest")
+            self.latest = self._cached('system-data/latest', self.latest_ttl,
+                                       lambda: self.get("/system-data/latest"))
         return self.latest
 
-    def read_setting(self, reg):
-        """read a register via the api"""
+    def reset(self):
+        """forget the in-process copy of the latest system data, eg between
+        jobs in a long-running process (the persistent cache still applies)"""
+        self.latest = None
+
+    def settings_table(self, refresh=False):
+        """the settings and presets available on the inverter, as
+        {'version', 'time', 'presets', 'settings'}. From the cache unless
+        refresh is set, or there isn't a (current version) cached copy."""
+        key = 'settings-table'
+        table = None if refresh else self._cache_get(key)
+        if table is None or table.get('version') != TABLE_VERSION:
+            table = { 'version': TABLE_VERSION,
+                      'time': time.time(),
+                      'presets': self.get('/presets'),
+                      'settings': self.get('/settings') }
+            self._cache_put(key, table, TABLE_TTL)
+        return table
+
+    def data_points(self, day, page_size=96):
+        """generator which yields the (5-minute) data points for a day, one
+        record at a time. day is a datetime.date. Points which aren't
+        after the previous one (eg where pages overlap) are dropped."""
+        last = None
+        for page in self.get_pages(f'/data-points/{day.isoformat()}?pageSize={page_size}'):
+            for point in page:
+                if last is not None and point['time'] <= last:
+                    continue
+                last = point['time']
+                yield point
+
+    def _cached(self, key, ttl, fetch):
+        """look up key in the persistent cache, or call fetch() to get it"""
+        value = self._cache_get(key)
+        if value is None:
+            value = fetch()
+            self._cache_put(key, value, ttl)
+        return value
+
+    def _cache_get(self, key):
+        if self.cache is None:
+            return None
+        return self.cache.get(self.cache_prefix + key)
+
+    def _cache_put(self, key, value, ttl):
+        if self.cache is not None:
+            self.cache.put(self.cache_prefix + key, value, ttl)
+
+    def _invalidate(self, key):
+        if self.cache is not None:
+            self.cache.delete(self.cache_prefix + key)
+
+    def _try_read(self, reg, end=None):
+        """single attempt at reading a register. Returns None on failure"""
+        json = self.post(f"/settings/{reg!s}/read", end=end)
+        return read_value(reg, json)
+
+    def _try_write(self, reg, value, end=None):
+        """single attempt at writing a register. Returns True on success"""
+        try:
+            json = self.post(f"/settings/{reg!s}/write", value=value, end=end)
+        finally:
+            # whatever the outcome, a cached value can no longer be trusted
+            self._invalidate(f'settings/{reg!s}')
+        return write_succeeded(reg, json)
+
+    def _backoff(self, end, delay, what):
+        """sleep before the next attempt, or give up if that would
+        take us past the deadline"""
+        if delay >= time_left(end):
+            raise IOError(f'{what}: gave up after {self.deadline}s')
+        time.sleep(delay)
+
+    def read_setting(self, reg, fresh=False):
+        """read a register via the api (or the cache, unless fresh is set).
+        Concurrent reads of the same register share one request."""
+        key = f'settings/{reg!s}'
+        if fresh:
+            self._invalidate(key)
+        return self.flights.do(key, lambda: self._cached(key, self.settings_ttl,
+                                                         lambda: self._read_setting(reg)))
+
+    def _read_setting(self, reg):
+        end = time.monotonic() + self.deadline
         delay = 2
         for attempt in range(10):
-            json = self.post(f"/settings/{reg!s}/read")
-            value = json['value']
-            # errors are returned as a -ve integer.
-            # Which is a bit inconvenient since a successful
-            # read might give a string rather than an integer.
-            if not isinstance(value, int) or value >= 0:
+            value = self._try_read(reg, end)
+            if value is not None:
                 return value
-            print(f'read {reg} got {value}: retrying')
-            time.sleep(delay)
+            print(f'read {reg}: retrying')
+            self._backoff(end, delay, f'read {reg}')
             delay = delay * 2
         raise IOError('too many attempts to read setting')
 
     def modify_setting(self, reg, value):
         """write a register via the api"""
+        end = time.monotonic() + self.deadline
         delay = 2
         for attempt in range(10):
-            json = self.post(f"/settings/{reg!s}/write", value=value)
-            print(f"modify {reg}: value: {json['value']}, success: {json['success']}, message: {json['message']}")
-            if json['success'] is True:
+            if self._try_write(reg, value, end):
                 return
-            time.sleep(delay)
+            self._backoff(end, delay, f'modify {reg}')
+            delay = delay * 2
+        raise IOError('too many attempts to modify setting')
+
+    def read_settings(self, regs, fresh=False):
+        """read several registers concurrently. Returns a dict of {reg: value}.
+        A register which cannot be read maps to None."""
+
+        def read(reg):
+            try:
+                return self.read_setting(reg, fresh)
+            except IOError as e:
+                print(f'read {reg} failed: {e}')
+                return None
+
+        from concurrent.futures import ThreadPoolExecutor
+        regs = list(regs)
+        with ThreadPoolExecutor(max_workers=POOL_SIZE) as pool:
+            return dict(zip(regs, pool.map(read, regs)))
+
+    def apply_settings(self, settings):
+        """Write a dict of {reg: value} as a single transaction.
+        The current values are read first (from the inverter, since a
+        cached value may be out of date), and registers which already
+        hold the wanted value are left alone. The rest are written
+        concurrently, and only the ones which fail are retried."""
+
+        current = self.read_settings(settings.keys(), fresh=True)
+        pending = {}
+        for reg, value in settings.items():
+            if same_value(current[reg], value):
+                print(f'modify {reg}: already {current[reg]}')
+            else:
+                pending[reg] = value
+
+        if not pending:
+            return
+        end = time.monotonic() + self.deadline
+        errors = {}     # reg: the exception from its last attempt, if it raised one
+
+        def write(item):
+            # an exception fails just this register, which stays pending
+            errors.pop(item[0], None)
+            try:
+                return self._try_write(*item, end)
+            except IOError as e:
+                print(f'modify {item[0]} failed: {e!r}')
+                errors[item[0]] = e
+                return False
+
+        from concurrent.futures import ThreadPoolExecutor
+        delay = 2
+        with ThreadPoolExecutor(max_workers=POOL_SIZE) as pool:
+            for attempt in range(10):
+                results = list(pool.map(write, pending.items()))
+                pending = {reg: value for (reg, value), ok in zip(pending.items(), results) if not ok}
+                if not pending:
+                    return
+                if delay >= time_left(end):
+                    break
+                print(f'modify {list(pending)} failed: retrying')
+                time.sleep(delay)
+                delay = delay * 2
+        last = next((errors[reg] for reg in reversed(pending) if reg in errors), None)
+        raise IOError(f'unable to modify settings {list(pending)}') from last
+
+class AsyncGivEnergyApi:
+    """asyncio version of GivEnergyApi, for doing lots of things in parallel,
+    or for use from within an event loop.
+
+    It borrows the configuration and cache from a GivEnergyApi. requests
+    is synchronous, so each request is run in a worker thread, but all
+    the waiting (including the backoff between retries) is done
+    without blocking the event loop. At most 'limit' requests are in
+    flight at any one time, and each is abandoned after 'timeout' seconds
+    (by default, the GivEnergyApi's).
+    Requests count against the same rate limit as the GivEnergyApi, and
+    concurrent reads of the same setting share one request.
+    """
+
+    def __init__(self, api=None, limit=POOL_SIZE, timeout=None):
+        import asyncio
+        if api is None:
+            api = GivEnergyApi()
+        self.api = api
+        self.timeout = timeout if timeout is not None else api.timeout
+        self.pool_size = limit
+        self._session = None
+        self.slots = asyncio.Semaphore(limit)   # for requests in flight
+        self.inflight = {}  # reads in progress
+
+    # low-level stuff
+
+    @property
+    def session(self):
+        if self._session is None:
+            from requests.adapters import Retry
+            # retries are done here, rather than sleeping inside urllib3
+            self._session = self.api.make_session(Retry(0), self.pool_size)
+        return self._session
+
+    async def _throttle(self):
+        import asyncio
+        # taking a token may mean a sqlite transaction on the shared
+        # cache, which can block on another process, so not in the loop
+        while (delay := await asyncio.to_thread(self.api.limiter.delay)) > 0:
+            await asyncio.sleep(delay)
+
+    async def _backoff(self, end, delay, what):
+        import asyncio
+        if delay >= time_left(end):
+            raise IOError(f'{what}: gave up after {self.api.deadline}s')
+        await asyncio.sleep(delay)
+
+    async def _request(self, method, url, end=None, **kwargs):
+        """perform a request, retrying on network errors and server errors,
+        until the deadline end (from time.monotonic())"""
+        import asyncio
+        from requests import RequestException
+        if end is None:
+            end = time.monotonic() + self.api.deadline
+        delay = 2
+        for attempt in range(10):
+            try:
+                await self._throttle()
+                timeout = min(self.timeout, time_left(end))
+                if timeout <= 0:
+                    raise IOError(f'{method} {url}: deadline exceeded')
+                async with self.slots:
+                    response = await asyncio.wait_for(
+                        asyncio.to_thread(self.session.request, method, self.api.url + url,
+                                          timeout=timeout, **kwargs),
+                        timeout)
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    return response.json()['data']
+                print(f'{method} {url} got {response.status_code}: retrying')
+            except (asyncio.TimeoutError, RequestException) as e:
+                if getattr(e, 'response', None) is not None:
+                    raise   # a 4xx from raise_for_status()
+                print(f'{method} {url} failed ({e!r}): retrying')
+            await self._backoff(end, delay, f'{method} {url}')
+            delay = delay * 2
+        raise IOError(f'too many attempts to {method} {url}')
+
+    async def get(self, url):
+        """perform a GET operation on the api"""
+        return await self._request('GET', url)
+
+    async def post(self, url, payload=None, value=None, end=None):
+        """perform a POST operation on the api"""
+        if payload is None:
+            payload={ 'context': self.api.context }
+        if value is not None:
+            payload['value'] = str(value)
+        return await self._request('POST', url, end, json=payload)
+
+    # higher level stuff
+
+    async def read_setting(self, reg, fresh=False):
+        """read a register via the api (or the cache, unless fresh is set)"""
+        import asyncio
+        key = f'settings/{reg!s}'
+        if fresh:
+            self.api._invalidate(key)
+        value = self.api._cache_get(key)
+        if value is not None:
+            return value
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._read_setting(reg, key))
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self.inflight.pop(key, None))
+        # shielded, so one caller giving up doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    async def _read_setting(self, reg, key):
+        end = time.monotonic() + self.api.deadline
+        delay = 2
+        for attempt in range(10):
+            json = await self.post(f"/settings/{reg!s}/read", end=end)
+            value = read_value(reg, json)
+            if value is not None:
+                self.api._cache_put(key, value, self.api.settings_ttl)
+                return value
+            print(f'read {reg}: retrying')
+            await self._backoff(end, delay, f'read {reg}')
+            delay = delay * 2
+        raise IOError('too many attempts to read setting')
+
+    async def modify_setting(self, reg, value):
+        """write a register via the api"""
+        end = time.monotonic() + self.api.deadline
+        delay = 2
+        for attempt in range(10):
+            try:
+                json = await self.post(f"/settings/{reg!s}/write", value=value, end=end)
+            finally:
+                self.api._invalidate(f'settings/{reg!s}')
+            if write_succeeded(reg, json):
+                return
+            await self._backoff(end, delay, f'modify {reg}')
             delay = delay * 2
         raise IOError('too many attempts to modify setting')
 
+    async def read_settings(self, regs, fresh=False):
+        """read several registers concurrently. Returns a dict of {reg: value}.
+        A register which cannot be read maps to None."""
+
+        async def read(reg):
+            try:
+                return await self.read_setting(reg, fresh)
+            except IOError as e:
+                print(f'read {reg} failed: {e}')
+                return None
+
+        import asyncio
+        regs = list(regs)
+        return dict(zip(regs, await asyncio.gather(*(read(reg) for reg in regs))))
+
+def read_value(reg, json):
+    """Extract the value from the response to a settings read.
+    Returns None if the inverter reported an error."""
+    value = json['value']
+    # errors are returned as a -ve integer.
+    # Which is a bit inconvenient since a successful
+    # read might give a string rather than an integer.
+    if not isinstance(value, int) or value >= 0:
+        return value
+    print(f'read {reg} got {value}')
+    return None
+
+def write_succeeded(reg, json):
+    """Check the response to a settings write"""
+    print(f"modify {reg}: value: {json['value']}, success: {json['success']}, message: {json['message']}")
+    return json['success'] is True
+
+def same_value(current, value):
+    """Compare a value read from the api with one we want to write.
+    Reads may come back as int, bool or str, but writes are always sent
+    as strings, so compare them in that form."""
+    if current is None:
+        return False
+    return str(current).lower() == str(value).lower()
+
+def validate(validation, value):
+    """Check a value against the validation rule from the settings table
+    (eg 'Value must be between 0 and 100'). Returns an error message,
+    or None if it's ok (or the rule isn't one we understand)."""
+    m = re.search(r'between (-?\d+) and (-?\d+)', validation)
+    if m:
+        try:
+            if int(m.group(1)) <= int(value) <= int(m.group(2)):
+                return None
+        except ValueError:
+            pass
+        return f'{value} is not between {m.group(1)} and {m.group(2)}'
+    m = re.search(r'one of: (.*)', validation)
+    if m:
+        choices = [c.strip().lower() for c in m.group(1).split(',')]
+        return None if str(value).lower() in choices else f'{value} is not one of {m.group(1)}'
+    if 'HH:mm' in validation:
+        m = re.fullmatch(r'(\d\d):(\d\d)', value)
+        if m and int(m.group(1)) < 24 and int(m.group(2)) < 60:
+            return None
+        return f'{value} is not a time (HH:MM)'
+    return None
+
+def load_table(api):
+    """the settings table, from the cache if possible. If the cached copy is
+    getting old, it is still used, but a refresh is started in the background."""
+    table = api.settings_table()
+    if time.time() - table['time'] > TABLE_REFRESH:
+        import subprocess
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'refresh'],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+    return table
+
+def snapshot(api, filename):
+    """save all the schedule-related settings to a file"""
+    import asyncio
+    # straight from the inverter, since cached values may be out of date
+    settings = asyncio.run(AsyncGivEnergyApi(api).read_settings(SNAPSHOT_SETTINGS, fresh=True))
+    missing = [reg for reg, value in settings.items() if value is None]
+    if missing:
+        raise IOError(f'unable to read settings {missing}')
+    with open(filename, 'w') as f:
+        json.dump({ 'inverter': api.config['givenergy']['inverter'],
+                    'time': datetime.now().isoformat(timespec='seconds'),
+                    'settings': settings }, f, separators=(',', ':'))
+    print(f'saved {len(settings)} settings to {filename}')
+
+def restore(api, filename):
+    """write back the settings saved by snapshot(), where they differ"""
+    with open(filename) as f:
+        saved = json.load(f)
+    if saved['inverter'] != api.config['givenergy']['inverter']:
+        print(f"warning: snapshot was taken from inverter {saved['inverter']}")
+    print(f"restoring snapshot from {saved['time']}")
+    # json keys are always strings
+    settings = { int(reg): value for reg, value in saved['settings'].items() }
+    # writes within a transaction happen in no particular order, so only
+    # enable discharge or pause once the slots they act on are in place
+    enables = { reg: settings.pop(reg) for reg in SNAPSHOT_ENABLES if reg in settings }
+    api.apply_settings(settings)
+    if enables:
+        api.apply_settings(enables)
+
 def main():
-    """If invoked as a script with no parameters, fetch the list of presets and settings available.
+    """If invoked as a script with no parameters, list the presets and settings available.
     Else each param is a setting to be either displayed or modified. eg
       cp=250 cl
-    will set charge_power and display charge_limit"""
+    will set charge_power and display charge_limit
+
+    'snapshot file' saves all the charge/discharge slots, pause timer and power
+    settings to a file, and 'restore file' writes back any which have changed.
+
+    Names are resolved, and values to be written are checked against the
+    settings table, before anything is sent to the api. The table is
+    cached; 'refresh' fetches it again."""
 
     api = GivEnergyApi()
 
-    names = { 'cp': CHARGE_POWER,
-              'dp': DISCHARGE_POWER,
-              'cl': CHARGE_LIMIT,
-              'pt': PAUSE_MODE,
-              'ps': PAUSE_START,
-              'pe': PAUSE_END,
-              'ds': DISCHARGE_START,
-              'de': DISCHARGE_END,
-              'ed': ENABLE_DC_DISCHARGE,
-              'eco': ECO_MODE,
-              }
-
-    # add numbered discharge slots
-    for idx in range(1,11):
-        names[f'cs{idx}'] = CHARGE_START_n[idx-1]
-        names[f'ce{idx}'] = CHARGE_END_n[idx-1]
-        names[f'cl{idx}'] = CHARGE_LIMIT_n[idx-1]
-        names[f'ds{idx}'] = DISCHARGE_START_n[idx-1]
-        names[f'de{idx}'] = DISCHARGE_END_n[idx-1]
-        names[f'dl{idx}'] = DISCHARGE_LIMIT_n[idx-1]
+    if len(sys.argv) == 3 and sys.argv[1] in ('snapshot', 'restore'):
+        if sys.argv[1] == 'snapshot':
+            snapshot(api, sys.argv[2])
+        else:
+            restore(api, sys.argv[2])
+        return
+
+    if sys.argv[1:] == ['refresh']:
+        table = api.settings_table(refresh=True)
+        print(f"{len(table['settings'])} settings, {len(table['presets'])} presets")
+        return
 
     if len(sys.argv) > 1:
         # each arg is a setting to be either displayed or (if followed by =val) modified.
+        ops = []
         for arg in (x.split('=', 1) for x in sys.argv[1:]):
             s = arg[0]
-            if s in names:
-                s = names[s]
-            else:
+            if s in NAMES:
+                s = NAMES[s]
+            elif s.isdigit():
                 s = int(s)
-            if len(arg) == 1:
-                # just retrieve the setting
-                val = api.read_setting(s)
-                print(s, val)
             else:
-                # set the value
-                api.modify_setting(s, arg[1])
+                sys.exit(f'unknown setting {s}')
+            ops.append((s, arg[1] if len(arg) > 1 else None))
+
+        # check all the writes before doing anything
+        if any(val is not None for s, val in ops):
+            rules = { x['id']: x['validation'] for x in load_table(api)['settings'] }
+            errors = []
+            for s, val in ops:
+                if val is None:
+                    continue
+                if s not in rules:
+                    errors.append(f'{s}: no such setting on this inverter')
+                elif (error := validate(rules[s], val)) is not None:
+                    errors.append(f'{s}: {error}')
+            if errors:
+                sys.exit('\n'.join(errors))
+
+        # Runs of reads are done concurrently, but otherwise things
+        # happen in the order given, so that 'cp=250 cp' shows the new value
+        for write, group in itertools.groupby(ops, key=lambda op: op[1] is not None):
+            if write:
+                for s, val in group:
+                    api.modify_setting(s, val)
+            else:
+                regs = [s for s, val in group]
+                # only go to the api for the ones that aren't cached
+                values = { reg: api._cache_get(f'settings/{reg!s}') for reg in regs }
+                missing = [reg for reg, value in values.items() if value is None]
+                if missing:
+                    import asyncio
+                    values.update(asyncio.run(AsyncGivEnergyApi(api).read_settings(missing)))
+                for s in regs:
+                    print(s, values[s])
     else:
         # just display the available settings
-        presets = api.get("/presets")
+        table = load_table(api)
         print('presets:')
-        for p in presets:
+        for p in table['presets']:
             print("{:3d} {:40s} : {:s}".format(p['id'], p['name'], p['description']))
-        settings = api.get("/settings")
         print('\nsettings:')
-        for s in settings:
+        for s in table['settings']:
             print("{:3d} {:40s} : {:s}".format(s['id'], s['name'], s['validation']))
 
 if __name__ == "__main__":
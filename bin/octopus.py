@@ -1,15 +1,31 @@
 #!/usr/bin/env python3
+
+"""
+Access to the Octopus GraphQL interface for IO charging slots.
+
+  octopus.py              print the charging slots
+  octopus.py --poll MINS  check every MINS minutes, and print any changes
+"""
+
+import base64
+import bisect
 import configparser
 import os
+import sys
+import time
 import requests,json
 from datetime import date, datetime,timezone,timedelta
+from requests.adapters import HTTPAdapter, Retry
 from requests.models import HTTPError
 from zoneinfo import ZoneInfo
 from operator import itemgetter
+from collections import namedtuple
+from cache import Cache
+from sensors import SensorWriter, sensors_path
 
 class IOG:
     """Access to Octopus GraphQL interface for IO charging slots"""
-    
+
     url = "https://api.octopus.energy/v1/graphql/"
 
     def __init__(self, config=None):
@@ -17,9 +33,24 @@ class IOG:
             config = configparser.ConfigParser()
             config.read(os.path.join(os.environ.get('HOME'), '.solar'))
 
+        self.config = config
         self.key = config['octopus']['key']
         self.acct = config['octopus']['account']
 
+        # one session, so that polling reuses the connection
+        session = requests.Session()
+        retries = Retry(total=5, backoff_factor=2, allowed_methods=None)  # None means all
+        session.mount(self.url, HTTPAdapter(max_retries=retries))
+        self.session = session
+
+        # kraken tokens last for an hour, so keep it in the persistent
+        # cache (shared with the givenergy scripts) rather than
+        # fetching a new one every time
+        self.cache = None
+        if config.getboolean('cache', 'enabled', fallback=True):
+            self.cache = Cache(config.get('cache', 'path', fallback=None))
+        self.token_key = f'octopus/{self.acct}/token'
+
     def refreshToken(self):
         try:
             query = """
@@ -30,7 +61,7 @@ class IOG:
             }
             """
             variables = {'api': self.key}
-            r = requests.post(self.url, json={'query': query , 'variables': variables})
+            r = self.session.post(self.url, json={'query': query , 'variables': variables})
             jsonResponse = json.loads(r.text)
             return jsonResponse['data']['obtainKrakenToken']['token']
         except HTTPError as http_err:
@@ -38,6 +69,21 @@ class IOG:
         except Exception as err:
             print(f'Another error occurred: {err}')
 
+    def getToken(self):
+        """return a token, from the cache if there's one which is still valid"""
+        token = self.cache.get(self.token_key) if self.cache else None
+        if token is None:
+            token = self.refreshToken()
+            if token and self.cache:
+                # keep it until a minute before it expires
+                ttl = tokenExpiry(token) - time.time() - 60
+                if ttl > 0:
+                    self.cache.put(self.token_key, token, ttl)
+        return token
+
+    def forgetToken(self):
+        if self.cache:
+            self.cache.delete(self.token_key)
 
     def getDispatches(self, token):
         try:
@@ -57,26 +103,27 @@ class IOG:
             """
             variables = {'input': self.acct}
             headers={"Authorization": token}
-            r = requests.post(self.url, json={'query': query , 'variables': variables, 'operationName': 'getData'},headers=headers)
+            r = self.session.post(self.url, json={'query': query , 'variables': variables, 'operationName': 'getData'},headers=headers)
             return json.loads(r.text)['data']
         except HTTPError as http_err:
             print(f'HTTP Error {http_err}')
         except Exception as err:
             print(f'Another error occurred: {err}')
 
-
-    @staticmethod
-    def getChargingSlots(config = None):
+    def chargingSlots(self):
         """Return an ordered array of 4-tuples (start, end, delta, completed).
 
         start and end are datetimes
         delta is the energy in kWh
         completed is True or False
         """
-        
-        iog = IOG(config);
-        authToken = iog.refreshToken()
-        dispatches = iog.getDispatches(authToken)
+
+        dispatches = self.getDispatches(self.getToken())
+        if not dispatches:
+            # perhaps the cached token has been revoked - try a fresh one
+            self.forgetToken()
+            dispatches = self.getDispatches(self.getToken())
+
         zone = ZoneInfo('Europe/London')
         results = []
         completed=False
@@ -92,10 +139,139 @@ class IOG:
         results.sort(key=itemgetter(1))  # sort by end-time
         return results
 
+    @staticmethod
+    def getChargingSlots(config = None):
+        """Return an ordered array of 4-tuples (start, end, delta, completed).
+        See chargingSlots()"""
 
+        return IOG(config).chargingSlots()
 
+    def dispatchStore(self, consumer):
+        """the persistent DispatchStore for this account. Each consumer
+        gets its own store, so it sees changes since it last looked."""
+        return DispatchStore(self.cache, f'octopus/{self.acct}/dispatches/{consumer}')
 
-if __name__ == "__main__":
-    slots = IOG.getChargingSlots()
+    def poll(self, interval):
+        """generator which fetches the charging slots every interval seconds,
+        over the same connection (and token)"""
+        while True:
+            yield self.chargingSlots()
+            time.sleep(interval)
+
+Changes = namedtuple('Changes', ('added', 'removed', 'changed'))
+
+class DispatchStore:
+    """Persistent record of the charging slots seen so far.
+
+    update() merges in a freshly-fetched list of slots and reports only
+    what has changed since the last time, so that downstream actions
+    need only happen when the schedule actually changes. changes()
+    reports the same without recording anything, for callers which
+    should only record the slots once they've acted on them. Slots are
+    identified by their start time (octopus extends a dispatch by moving
+    its end), and kept ordered by end time, so that "slots still to
+    come" is just a bisect.
+
+    The store lives in the persistent cache, if there is one.
+    """
+
+    # how long to remember a completed slot after it ends
+    RETAIN = timedelta(days=2)
+
+    def __init__(self, cache=None, key='octopus/dispatches'):
+        self.cache = cache
+        self.key = key
+        saved = cache.get(key) if cache else None
+        self._set([(datetime.fromisoformat(s), datetime.fromisoformat(e), d, c)
+                   for s, e, d, c in saved or ()])
+        # nothing at all was known before this run
+        self.empty = saved is None
+
+    def _set(self, slots):
+        slots.sort(key=itemgetter(1))
+        self.slots = slots
+        self.ends = [slot[1] for slot in slots]
+        self.byStart = {slot[0]: slot for slot in slots}
+
+    def _merge(self, slots):
+        """the Changes, and the merged list of slots"""
+        added = []
+        changed = []
+        fresh = {}
+        for slot in slots:
+            old = self.byStart.get(slot[0])
+            if old is None:
+                added.append(slot)
+            elif old != slot:
+                changed.append(slot)
+            fresh[slot[0]] = slot
+
+        # A planned slot which has vanished has been cancelled. Completed
+        # ones just drop out of octopus's list after a while, so keep
+        # them for a bit.
+        cutoff = datetime.now(timezone.utc) - self.RETAIN
+        removed = []
+        for slot in self.slots:
+            if slot[0] not in fresh:
+                if not slot[3]:
+                    removed.append(slot)
+                elif slot[1] > cutoff:
+                    fresh[slot[0]] = slot
+
+        return Changes(added, removed, changed), list(fresh.values())
+
+    def changes(self, slots):
+        """what update() would report for the slots, without recording them"""
+        return self._merge(slots)[0]
+
+    def update(self, slots):
+        """Merge in the latest slots (as returned by chargingSlots()).
+        Returns a Changes of the added, removed and changed slots."""
+        changes, merged = self._merge(slots)
+        self._set(merged)
+        if self.cache:
+            self.cache.put(self.key, [(s.isoformat(), e.isoformat(), d, c) for s, e, d, c in self.slots],
+                           self.RETAIN.total_seconds())
+        return changes
+
+    def after(self, t):
+        """the slots which end after time t, in order of end time"""
+        return self.slots[bisect.bisect_right(self.ends, t):]
+
+    def active(self, t):
+        """the slots in progress at time t"""
+        return [slot for slot in self.after(t) if slot[0] <= t]
+
+def tokenExpiry(token):
+    """Return the expiry time (epoch seconds) of a kraken token.
+    It's a JWT, so the expiry is in the (base64-encoded json) payload."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['exp']
+    except (IndexError, ValueError, KeyError):
+        return 0
+
+
+def printSlots(slots):
     for x in slots:
         print(x[0], x[1], x[2], x[3])
+
+if __name__ == "__main__":
+    iog = IOG()
+    if len(sys.argv) > 2 and sys.argv[1] == '--poll':
+        # just report the changes each time
+        # also pass them on to the modbus monitor, via the sensors file
+        store = iog.dispatchStore('octopus.py')
+        sensors = SensorWriter(sensors_path(iog.config))
+        for slots in iog.poll(float(sys.argv[2]) * 60):
+            changes = store.update(slots)
+            if any(changes):
+                sensors.set_dispatches(slots)
+                print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                for what, slots in zip(Changes._fields, changes):
+                    if slots:
+                        print(what)
+                        printSlots(slots)
+    else:
+        printSlots(iog.chargingSlots())
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""
+Plans the overnight charge and the evening discharge, from a forecast
+of load and solar built from the data-points archive. Nothing is
+downloaded here: archive.py (run nightly by the daemon, or from cron)
+keeps the archive up to date.
+
+The forecast is the average load and solar for each half-hour slot of
+the day over the last few days. Given the current SoC and a target,
+plan_charge() finds the lowest constant power which reaches the target
+by the end of the charge window(s), allowing for what the house will
+draw from the battery before and between them. plan_discharge() does
+the same for dumping charge: the lowest constant discharge power which
+gets down to the target by the end of the discharge window(s), or no
+forced discharge at all if the house load will do it anyway.
+
+Both return a Plan, and charge_writes() / discharge_writes() turn that
+into the settings to write (power, plus start/end/limit for each slot).
+The charge slots are only written if [planner] charge is set, since
+otherwise they're whatever was set up in the app, and the planner only
+assumes them.
+
+Config is in an optional [planner] section:
+  charge = 00:30-05:30      charge window(s), comma-separated
+  discharge = 22:00-23:30   discharge window(s)
+  charge_slot = 2           first charge slot to use (consecutive slots
+  discharge_slot = 1        for further windows)
+  days = 14                 days of history to average over
+  base_load = 300           W, assumed where there's no history
+  efficiency = 0.95         battery round-trip losses, each way
+  max_discharge = 30        most SoC (%) to get rid of in one discharge
+and [givenergy] battery_capacity (Wh, default 9500).
+
+How much the battery actually charges or discharges at a given setting
+(a bit more than asked) comes from the response model the monitor fits
+(see response.py), so the settings are sized to give the power wanted.
+
+As a script, prints the forecast and the plans.
+"""
+
+import sys
+from array import array
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from archive import DataPointArchive
+from response import ResponseModel
+from givenergy import (
+    CHARGE_POWER, DISCHARGE_POWER,
+    CHARGE_START_n, CHARGE_END_n, CHARGE_LIMIT_n,
+    DISCHARGE_START_n, DISCHARGE_END_n, DISCHARGE_LIMIT_n,
+)
+
+SLOT = 30                       # minutes
+SLOTS = 24 * 60 // SLOT         # per day
+MAX_POWER = 3600                # W, the most the api will accept
+
+# response is a ResponseModel
+Battery = namedtuple('Battery', 'capacity efficiency response')
+
+# power is what to set (W), or None if nothing needs doing. windows is a
+# list of (start, end) datetimes, and limit the SoC to stop at. soc is the
+# SoC projected at the start of the first window, and reached is what
+# we expect at the end of the last.
+Plan = namedtuple('Plan', 'power windows limit soc reached')
+
+class Forecast:
+    """average load and solar (W) for each slot of the day"""
+
+    def __init__(self, load, solar):
+        self.load = load
+        self.solar = solar
+
+    @staticmethod
+    def build(archive, today, days=14, base_load=300):
+        """from the archived data points of the days before today. Days
+        not in the archive are skipped: keeping it up to date is left to
+        archive.py, so that planning never waits on downloads."""
+        sums = { 'load': array('d', [0]) * SLOTS, 'solar': array('d', [0]) * SLOTS }
+        counts = array('i', [0]) * SLOTS
+        for n in range(1, days + 1):
+            columns = archive.load(today - timedelta(days=n))
+            if not columns:
+                continue
+            for t, load, solar in zip(columns['time'], columns['consumption_power'], columns['solar_power']):
+                d = datetime.fromtimestamp(t)
+                i = (d.hour * 60 + d.minute) // SLOT
+                sums['load'][i] += load
+                sums['solar'][i] += solar
+                counts[i] += 1
+        load = array('d', (s / c if c else base_load for s, c in zip(sums['load'], counts)))
+        solar = array('d', (s / c if c else 0 for s, c in zip(sums['solar'], counts)))
+        return Forecast(load, solar)
+
+    def energy(self, start, end, values):
+        """Wh between two datetimes, for one of the series"""
+        total = 0.0
+        t = start
+        while t < end:
+            i = (t.hour * 60 + t.minute) // SLOT
+            boundary = t.replace(minute=i * SLOT % 60, second=0, microsecond=0) + timedelta(minutes=SLOT)
+            step = min(boundary, end)
+            total += values[i] * (step - t).total_seconds() / 3600
+            t = step
+        return total
+
+    def drain(self, start, end):
+        """Wh the house will take from the battery between two times
+        (load not covered by solar)"""
+        return max(0.0, self.energy(start, end, self.load) - self.energy(start, end, self.solar))
+
+def parse_windows(spec, now):
+    """'HH:MM-HH:MM,...' to a list of (start, end) datetimes, the next
+    occurrence of each after now, in order"""
+    windows = []
+    after = now
+    for part in spec.split(','):
+        start, end = (datetime.strptime(x.strip(), '%H:%M').time() for x in part.split('-'))
+        s = datetime.combine(after.date(), start)
+        if s < after:
+            s += timedelta(days=1)
+        e = datetime.combine(s.date(), end)
+        if e <= s:
+            e += timedelta(days=1)
+        windows.append((s, e))
+        after = e
+    return windows
+
+def hours(windows):
+    return sum((e - s).total_seconds() for s, e in windows) / 3600
+
+def outside(forecast, now, windows):
+    """drain from now to the first window, and in the gaps between windows"""
+    total = forecast.drain(now, windows[0][0])
+    for (_, e), (s, _) in zip(windows, windows[1:]):
+        total += forecast.drain(e, s)
+    return total
+
+def plan_charge(forecast, battery, now, soc, target, windows):
+    """the lowest constant charge power to reach target % by the end of windows"""
+    pct = battery.capacity / 100
+    soc_start = max(0.0, soc - forecast.drain(now, windows[0][0]) / battery.efficiency / pct)
+    # the house runs off the grid while charging, but off the battery in between
+    drain = outside(forecast, now, windows) / battery.efficiency
+    needed = (target - soc) * pct + drain
+    if needed <= 0:
+        return Plan(None, windows, target, soc_start, soc - drain / pct)
+    power = needed / battery.efficiency / hours(windows)
+    setting = min(MAX_POWER, battery.response.charge_setting(power, battery.capacity))
+    delivered = battery.response.charge_actual(setting, battery.capacity) * hours(windows) * battery.efficiency
+    reached = min(target, soc + (delivered - drain) / pct)
+    return Plan(setting, windows, target, soc_start, reached)
+
+def plan_discharge(forecast, battery, now, soc, target, windows):
+    """the lowest constant discharge power to get down to target % by the
+    end of windows. power is None if the house load will get there anyway."""
+    # everything here is in Wh as seen on the AC side
+    pct = battery.capacity / 100 * battery.efficiency
+    soc_start = max(0.0, soc - forecast.drain(now, windows[0][0]) / pct)
+    drain = outside(forecast, now, windows)
+    excess = (soc - target) * pct - drain
+    load = forecast.drain(windows[0][0], windows[-1][1]) - outside(forecast, windows[0][0], windows)
+    if excess <= load:
+        # normal consumption takes care of it
+        return Plan(None, windows, target, soc_start, max(0.0, soc - (drain + load) / pct))
+    # the forced discharge covers the house load, and exports the rest
+    power = excess / hours(windows)
+    setting = min(MAX_POWER, battery.response.discharge_setting(power, battery.capacity))
+    delivered = battery.response.discharge_actual(setting, battery.capacity) * hours(windows)
+    reached = max(target, soc - (delivered + drain) / pct)
+    return Plan(setting, windows, target, soc_start, reached)
+
+def hhmm(t):
+    return t.strftime('%H:%M')
+
+def charge_writes(plan, first_slot=2, slots=True):
+    """settings for a charge plan, using consecutive slots from first_slot.
+    Without slots, just the power."""
+    settings = { CHARGE_POWER: plan.power or 0 }
+    if not slots:
+        return settings
+    for n, (s, e) in enumerate(plan.windows, first_slot - 1):
+        settings[CHARGE_START_n[n]] = hhmm(s)
+        settings[CHARGE_END_n[n]] = hhmm(e)
+        settings[CHARGE_LIMIT_n[n]] = plan.limit
+    return settings
+
+def discharge_writes(plan, first_slot=1):
+    """settings for a discharge plan. Empty if there's nothing to do."""
+    if plan.power is None:
+        return {}
+    settings = { DISCHARGE_POWER: plan.power }
+    for n, (s, e) in enumerate(plan.windows, first_slot - 1):
+        settings[DISCHARGE_START_n[n]] = hhmm(s)
+        settings[DISCHARGE_END_n[n]] = hhmm(e)
+        settings[DISCHARGE_LIMIT_n[n]] = plan.limit
+    return settings
+
+class Planner:
+    """the forecast and settings from the config, ready to plan with"""
+
+    def __init__(self, config, now=None, response=None):
+        section = config['planner'] if config.has_section('planner') else {}
+        self.now = now or datetime.now()
+        self.charge = section.get('charge', '00:30-05:30')
+        # whether the charge window is ours to set, or just assumed
+        self.charge_configured = 'charge' in section
+        self.discharge = section.get('discharge', '22:00-23:30')
+        self.charge_slot = int(section.get('charge_slot', 2))
+        self.discharge_slot = int(section.get('discharge_slot', 1))
+        self.max_discharge = int(section.get('max_discharge', 30))
+        self.battery = Battery(config.getfloat('givenergy', 'battery_capacity', fallback=9500),
+                               float(section.get('efficiency', 0.95)),
+                               response or ResponseModel.load())
+        self.forecast = Forecast.build(DataPointArchive(config=config), self.now.date(),
+                                       int(section.get('days', 14)), float(section.get('base_load', 300)))
+
+    def plan_charge(self, soc, target):
+        return plan_charge(self.forecast, self.battery, self.now, soc, target,
+                           parse_windows(self.charge, self.now))
+
+    def plan_discharge(self, soc, target):
+        # however full the battery, don't dump more than max_discharge
+        target = max(target, round(soc - self.max_discharge))
+        return plan_discharge(self.forecast, self.battery, self.now, soc, target,
+                              parse_windows(self.discharge, self.now))
+
+def describe(plan):
+    windows = ', '.join(f'{hhmm(s)}-{hhmm(e)}' for s, e in plan.windows)
+    power = 'nothing to do' if plan.power is None else f'{plan.power}W'
+    return f'{windows}: {power}, SoC {plan.soc:.0f}% at start, {plan.reached:.0f}% at end (limit {plan.limit}%)'
+
+def main():
+    import configparser
+    import os
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.environ.get('HOME'), '.solar'))
+    soc = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    planner = Planner(config)
+    print(' slot   load  solar')
+    for i in range(SLOTS):
+        print(f'{i*SLOT//60:02d}:{i*SLOT%60:02d} {planner.forecast.load[i]:6.0f} {planner.forecast.solar[i]:6.0f}')
+    print('charge to 100%:  ', describe(planner.plan_charge(soc, 100)))
+    print('discharge to 6%: ', describe(planner.plan_discharge(soc, 6)))
+
+if __name__ == "__main__":
+    main()
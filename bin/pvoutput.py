@@ -3,60 +3,180 @@
 """
 A simple script to run after sundown, to download
 the day's data and upload it to pvoutput.org
+
+  pvoutput.py                 upload today, from the latest meter data
+  pvoutput.py YYYYMMDD        upload a given day
+  pvoutput.py --from YYYYMMDD --to YYYYMMDD
+                              backfill a range of days, in batches
+
+If the [pvoutput] section has an 'offpeak' setting (eg 23:30-05:30, local
+time), import is split into peak and off-peak, by picking out the
+transition points from the day's data points.
 """
 
-# TODO: would be nice to distinguish off-peak and peak-rate
-# import - just need to use the datapoints version and pick
-# out the transition points.
+import argparse
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
-import sys
 import requests
+from archive import DataPointArchive, parse_day
 from givenergy import GivEnergyApi
 
-def upload(config, day, solar, export):
-    """upload the results to pvoutput.org"""
-    url='https://pvoutput.org/service/r2/addoutput.jsp'
+URL = 'https://pvoutput.org/service/r2/'
+
+# outputs per addbatchoutput call (pvoutput's limit for non-donors)
+BATCH_SIZE = 30
+
+class PVOutput:
+    """minimal client for the pvoutput.org api, using one pooled connection,
+    and keeping within the rate limit"""
+
+    def __init__(self, config):
+        self.url = config.get('url', URL)
+        session = requests.Session()
+        session.headers.update({
+            'X-Pvoutput-Apikey': config['key'],
+            'X-Pvoutput-SystemId': config['id'],
+            'X-Rate-Limit': '1'   # ask for the rate limit headers
+        })
+        self.session = session
+        self.remaining = None
+        self.reset = None
+
+    def post(self, service, payload):
+        if self.remaining == 0 and self.reset is not None:
+            wait = self.reset - time.time()
+            if wait > 0:
+                print(f'pvoutput rate limit reached: waiting {wait:.0f}s')
+                time.sleep(wait)
+        response = self.session.request('POST', self.url + service, data=payload)
+        if 'X-Rate-Limit-Remaining' in response.headers:
+            self.remaining = int(response.headers['X-Rate-Limit-Remaining'])
+            self.reset = int(response.headers['X-Rate-Limit-Reset'])
+        response.raise_for_status()
+        return response.text
+
+    def add_output(self, output):
+        """upload a single day (a dict of d, g, e and optionally ip, io)"""
+        return self.post('addoutput.jsp', output)
+
+    def add_outputs(self, outputs):
+        """upload many days, in as few requests as possible"""
+        for i in range(0, len(outputs), BATCH_SIZE):
+            lines = []
+            for o in outputs[i:i+BATCH_SIZE]:
+                # date,generated,exported,peak power,peak time,condition,
+                # min temp,max temp,comments,import peak,import off-peak
+                fields = [o['d'], o['g'], o['e'], '', '', '', '', '', '', o.get('ip', ''), o.get('io', '')]
+                lines.append(','.join(str(f) for f in fields).rstrip(','))
+            print(self.post('addbatchoutput.jsp', {'data': ';'.join(lines)}))
+
+def offpeak_window(config):
+    """parse the offpeak setting into a pair of minutes-of-day, or None"""
+    offpeak = config.get('offpeak')
+    if not offpeak:
+        return None
+    start, end = (datetime.strptime(t.strip(), '%H:%M') for t in offpeak.split('-'))
+    return (start.hour * 60 + start.minute, end.hour * 60 + end.minute)
+
+def import_split(columns, window, zone):
+    """Divide the day's import (kWh) into (peak, offpeak).
+    Each data point carries the cumulative import for the day, so each
+    increase is allocated according to the time of the point at the end
+    of the interval."""
+    start, end = window
+    peak = offpeak = 0.0
+    previous = 0.0
+    for t, total in zip(columns['time'], columns['today_import']):
+        local = datetime.fromtimestamp(t, zone)
+        mins = local.hour * 60 + local.minute
+        inside = start <= mins < end if start < end else mins >= start or mins < end
+        delta = total - previous
+        if delta > 0:
+            if inside:
+                offpeak += delta
+            else:
+                peak += delta
+        previous = total
+    return peak, offpeak
+
+def output(day, solar, export, split=None):
+    """assemble the record for a day"""
+    print(day.strftime('%Y%m%d'), solar, export, *(split or ()))
 
     # seems to reject record if export exceeds solar by too much
     if export > solar*1.1: export = solar*1.1
 
-    headers = {
-        'X-Pvoutput-Apikey': config['key'],
-        'X-Pvoutput-SystemId': config['id']
-    }
-    payload={
-        'd': day,
+    o = {
+        'd': day.strftime('%Y%m%d'),
         'g': int(solar*1000),
         'e': int(export*1000)
     }
-    #print(url, headers, payload)
-    response = requests.request('POST', url, headers=headers, data=payload)
-    response.raise_for_status()
-    # print(response, response.text)
+    if split is not None:
+        o['ip'] = int(split[0]*1000)
+        o['io'] = int(split[1]*1000)
+    return o
+
+def day_output(api, archive, day, window, zone):
+    """the record for a day, from the archived data points"""
+    columns = archive.fetch(api, day)
+    if len(columns['time']) == 0:
+        return None
+    split = import_split(columns, window, zone) if window else None
+    return output(day, columns['today_solar'][-1], columns['today_export'][-1], split)
+
+def run(api, pvoutput=None):
+    """upload today's totals, from the latest meter data"""
+    config = api.config['pvoutput']
+    if pvoutput is None:
+        pvoutput = PVOutput(config)
+    archive = DataPointArchive(config=api.config)
+    window = offpeak_window(config)
+    zone = ZoneInfo(config.get('timezone', 'Europe/London'))
+
+    # just use the latest meter data, and we can get
+    # the date from that
+    # TODO: will it always be UTC ?
+    data = api.get('/meter-data/latest')
+    today = data['today']
+    day = parse_day(data['time'][0:10])  # yyyy-mm-ddThh:mm:ssZ
+    split = import_split(archive.fetch(api, day), window, zone) if window else None
+    pvoutput.add_output(output(day, float(today['solar']), float(today['grid']['export']), split))
 
 def main():
+    parser = argparse.ArgumentParser(description='upload daily totals to pvoutput.org')
+    parser.add_argument('day', nargs='?', help='day to upload (default today)')
+    parser.add_argument('--from', dest='start', help='first day to backfill')
+    parser.add_argument('--to', dest='end', help='last day to backfill (default yesterday)')
+    args = parser.parse_args()
+
     api = GivEnergyApi('pvoutput')
+    if not args.start and not args.day:
+        run(api)
+        return
+
+    config = api.config['pvoutput']
+    pvoutput = PVOutput(config)
+    archive = DataPointArchive(config=api.config)
+    window = offpeak_window(config)
+    zone = ZoneInfo(config.get('timezone', 'Europe/London'))
 
-    if len(sys.argv) > 1:
-        # bit sloppy - get all the data and pick out just
-        # the last one
-        day = sys.argv[1]
-        data = api.get(f'/data-points/{day}?pageSize=4096')
-        today = data[-1]['today']
-    else:
-        # just use the latest meter data, and we can get
-        # the date from that
-        # TODO: will it always be UTC ?
-        data = api.get('/meter-data/latest')
-        today = data['today']
-        time = data['time']  # yyyy-mm-ddThh:mm:ssZ
-        day = time[0:4] + time[5:7] + time[8:10]
-
-    solar = float(today['solar'])
-    export = float(today['grid']['export'])
-    print(day, solar, export)
-
-    upload(api.config['pvoutput'], day, solar, export)
+    if args.start:
+        start = parse_day(args.start)
+        end = parse_day(args.end) if args.end else datetime.now().date() - timedelta(days=1)
+        outputs = []
+        day = start
+        while day <= end:
+            o = day_output(api, archive, day, window, zone)
+            if o is not None:
+                outputs.append(o)
+            day += timedelta(days=1)
+        pvoutput.add_outputs(outputs)
+    elif args.day:
+        o = day_output(api, archive, parse_day(args.day), window, zone)
+        if o is not None:
+            pvoutput.add_output(o)
 
 if __name__ == "__main__":
     main()
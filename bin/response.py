@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""
+A model of how the battery responds to the inverter's charge and
+discharge limits, fitted from what the monitor actually sees.
+
+The limits are in units of 1% of battery capacity per hour, but the
+battery doesn't quite do as it's told: charging is about 97.5W per
+unit plus 185W (and 0 behaves like 1), and discharging a little over
+97.5W per unit. Rather than hard-coding those, each is modelled as a
+straight line
+  charging W    = charge.slope * max(cp, 1) + charge.offset
+  discharging W = discharge.slope * dp + discharge.offset     (dp >= 1)
+fitted by recursive least squares with exponential forgetting: each
+sample updates the fit in constant time and space (two coefficients
+and a 2x2 covariance per line), and older samples gradually count for
+less, so it follows drift (battery ageing, firmware updates) without
+ever refitting from scratch. Until there are samples, the fit is the
+old hard-coded values.
+
+The monitor feeds it each cycle via observe(), which only uses samples
+where the battery really is at its limit (eg charging while still
+exporting, so it's the limit and not the surplus that's holding it
+back), and saves it as JSON to ~/.cache/givenergy/response.json, where
+the scripts (via planner.py) load it to size their settings.
+
+As a script, prints the current fit.
+"""
+
+import json
+import math
+import os
+import sys
+
+DEFAULT_PATH = os.path.join(os.environ.get('HOME'), '.cache', 'givenergy', 'response.json')
+
+# weight of each sample relative to the one after it. 0.999 means
+# roughly the last 1000 samples count (a few days of monitor cycles)
+FORGET = 0.999
+
+# initial covariance: how far the defaults are trusted. And a cap on it,
+# since forgetting makes it grow without bound while the limit doesn't
+# change (eg cp sitting at one value all afternoon)
+PRIOR = (1.0, 1e4)
+MAX_TRACE = 1e6
+
+# only use samples where the battery is clearly at its limit
+EXPORT_MARGIN = 100     # W being exported
+MIN_POWER = 50          # W into / out of the battery
+MAX_CHARGE_SOC = 95     # above this, charging tapers off
+MIN_DISCHARGE_SOC = 10  # near the reserve, it's cut back
+MAX_DP = 36             # above this, discharge is at the inverter's maximum
+MAX_CP = 25             # above this, charging can be held back by the battery itself
+
+# what's plausible for the fit. Nearly 1% of a 9.5kWh battery per unit,
+# plus a bit: anything well outside that means the samples were bad,
+# so the fit is kept within these
+SLOPE_RANGE = (80.0, 120.0)
+OFFSET_RANGE = (-200.0, 400.0)
+
+def clamp(value, bounds):
+    lo, hi = bounds
+    return min(hi, max(lo, value))
+
+class Line:
+    """y = slope * x + offset, fitted incrementally"""
+
+    def __init__(self, slope, offset, p=None, n=0):
+        self.slope = clamp(slope, SLOPE_RANGE)
+        self.offset = clamp(offset, OFFSET_RANGE)
+        # covariance, as [[a, b], [b, d]] flattened
+        self.p = list(p) if p is not None else [PRIOR[0], 0.0, 0.0, PRIOR[1]]
+        self.n = n
+
+    def __call__(self, x):
+        return self.slope * x + self.offset
+
+    def inverse(self, y):
+        return (y - self.offset) / self.slope
+
+    def update(self, x, y, forget=FORGET):
+        a, b, _, d = self.p
+        # P.phi, where phi = (x, 1)
+        px = a * x + b
+        p1 = b * x + d
+        gain = forget + x * px + p1
+        kx, k1 = px / gain, p1 / gain
+        error = y - self(x)
+        self.slope = clamp(self.slope + kx * error, SLOPE_RANGE)
+        self.offset = clamp(self.offset + k1 * error, OFFSET_RANGE)
+        # P = (P - k.(P.phi)') / forget
+        a = (a - kx * px) / forget
+        b = (b - kx * p1) / forget
+        d = (d - k1 * p1) / forget
+        if a + d > MAX_TRACE:
+            scale = MAX_TRACE / (a + d)
+            a, b, d = a * scale, b * scale, d * scale
+        self.p = [a, b, b, d]
+        self.n += 1
+
+    def to_dict(self):
+        return { 'slope': self.slope, 'offset': self.offset, 'p': self.p, 'n': self.n }
+
+    @staticmethod
+    def from_dict(d):
+        return Line(d['slope'], d['offset'], d['p'], d['n'])
+
+class ResponseModel:
+    """charge and discharge power as a function of the limits"""
+
+    def __init__(self, charge=None, discharge=None):
+        self.charge = charge or Line(97.5, 185.0)
+        # 97.5W per unit, and the scripts found it discharged about
+        # 100W more than set at typical rates
+        self.discharge = discharge or Line(97.5, 55.0)
+
+    # in the inverter's units (as the monitor uses them)
+
+    def charge_power(self, cp):
+        """W the battery will charge at with limit cp"""
+        return self.charge(max(cp, 1))
+
+    def charge_limit(self, watts):
+        """the lowest limit which charges at (at least) watts"""
+        return max(0, math.ceil(self.charge.inverse(watts) - 1e-6))
+
+    def discharge_power(self, dp):
+        return self.discharge(dp) if dp >= 1 else 55.0
+
+    def discharge_limit(self, watts):
+        return max(1, math.ceil(self.discharge.inverse(watts) - 1e-6))
+
+    # in Watts, as the cloud api takes the settings. capacity is the
+    # battery's in Wh, so one unit is capacity/100 W.
+
+    def charge_setting(self, watts, capacity):
+        return round(self.charge_limit(watts) * capacity / 100)
+
+    def charge_actual(self, setting, capacity):
+        return self.charge_power(round(setting * 100 / capacity))
+
+    def discharge_setting(self, watts, capacity):
+        return round(self.discharge_limit(watts) * capacity / 100)
+
+    def discharge_actual(self, setting, capacity):
+        return self.discharge_power(round(setting * 100 / capacity))
+
+    def observe(self, cp, dp, paused, battery, export, soc):
+        """learn from one set of readings. battery is the battery's
+        discharge power (so -ve when charging). Returns the line which
+        was updated, if any."""
+        if None in (cp, dp, battery, export, soc):
+            return None
+        if export < EXPORT_MARGIN:
+            return None
+        if battery < -MIN_POWER and not paused and soc < MAX_CHARGE_SOC and cp <= MAX_CP:
+            # still exporting, so it's the limit holding charging back
+            self.charge.update(max(cp, 1), -battery)
+            return self.charge
+        if battery > MIN_POWER and 1 <= dp <= MAX_DP and soc > MIN_DISCHARGE_SOC:
+            # discharging while exporting, so it's a forced discharge
+            self.discharge.update(dp, battery)
+            return self.discharge
+        return None
+
+    def to_dict(self):
+        return { 'charge': self.charge.to_dict(), 'discharge': self.discharge.to_dict() }
+
+    def save(self, path=DEFAULT_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so that a script never sees half a file
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path=DEFAULT_PATH):
+        """the saved model, or the defaults if there isn't one (yet)"""
+        try:
+            with open(path) as f:
+                d = json.load(f)
+            return ResponseModel(Line.from_dict(d['charge']), Line.from_dict(d['discharge']))
+        except FileNotFoundError:
+            return ResponseModel()
+        except (ValueError, KeyError) as e:
+            print(f'ignoring bad response model {path}: {e!r}')
+            return ResponseModel()
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH
+    model = ResponseModel.load(path)
+    for name, line in (('charge', model.charge), ('discharge', model.discharge)):
+        print(f'{name:9s} {line.slope:6.1f}W per unit {line.offset:+6.1f}W  ({line.n} samples)')
+    print('limit  charge  discharge')
+    for x in (0, 1, 2, 5, 10, 20, 30):
+        print(f'{x:5d} {model.charge_power(x):7.0f} {model.discharge_power(x):10.0f}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+A small shared-memory file for passing data (IOG dispatches, zappi state)
+from the cron / polling scripts into the long-running modbus monitor.
+
+The file (/tmp/sensors by default, or 'path' in a [sensors] section) has
+a fixed binary layout, and is mmap-ed by both sides. The header has a
+sequence counter used as a seqlock: a writer makes it odd while it is
+updating the file, and even again when it has finished. So a reader
+only needs to look at the counter each cycle - if it hasn't changed,
+there's nothing new, and no syscall is involved. If it has changed, the
+reader copies the data and checks the counter again, retrying if a
+write was in progress.
+
+Writers also take an flock on the file, so that several writers don't
+trip over each other.
+
+Layout (native byte order - it never leaves the machine):
+  header:     magic 'GESN', version (u16), pad (u16), sequence (u64)
+  zappi:      updated (f64), status (i32), power W (i32), charge added Wh (i32), pad (i32)
+  dispatches: updated (f64), count (u32), pad (u32)
+              then MAX_DISPATCHES x (start (f64), end (f64), kWh (f32), completed (u32))
+Times are epoch seconds; 'updated' is 0 if that section has never been written.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from datetime import datetime
+
+MAGIC = b'GESN'
+VERSION = 1
+DEFAULT_PATH = '/tmp/sensors'
+MAX_DISPATCHES = 16
+
+HEADER = struct.Struct('=4sHHQ')
+ZAPPI = struct.Struct('=diiii')
+DISPATCHES = struct.Struct('=dII')
+DISPATCH = struct.Struct('=ddfI')
+
+ZAPPI_OFFSET = HEADER.size
+DISPATCHES_OFFSET = ZAPPI_OFFSET + ZAPPI.size
+SIZE = DISPATCHES_OFFSET + DISPATCHES.size + MAX_DISPATCHES * DISPATCH.size
+
+# offset of the sequence counter within the header
+SEQ_OFFSET = 8
+SEQ = struct.Struct('=Q')
+
+Zappi = namedtuple('Zappi', ('updated', 'status', 'power', 'added'))
+Dispatch = namedtuple('Dispatch', ('start', 'end', 'delta', 'completed'))
+Sensors = namedtuple('Sensors', ('seq', 'zappi', 'dispatches_updated', 'dispatches'))
+
+def sensors_path(config=None):
+    if config is not None:
+        return config.get('sensors', 'path', fallback=DEFAULT_PATH)
+    return DEFAULT_PATH
+
+def _open(path):
+    """open (creating if necessary) the sensors file, and map it"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < SIZE:
+                os.ftruncate(fd, SIZE)
+                os.pwrite(fd, HEADER.pack(MAGIC, VERSION, 0, 0), 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        return fd, mmap.mmap(fd, SIZE)
+    except Exception:
+        os.close(fd)
+        raise
+
+class SensorWriter:
+    """used by external scripts to update the sensors file"""
+
+    def __init__(self, path=None):
+        self.fd, self.mm = _open(path or DEFAULT_PATH)
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    def _update(self, offset, data):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            seq, = SEQ.unpack_from(self.mm, SEQ_OFFSET)
+            seq |= 1    # odd while writing (it should be even already)
+            SEQ.pack_into(self.mm, SEQ_OFFSET, seq)
+            self.mm[offset:offset+len(data)] = data
+            SEQ.pack_into(self.mm, SEQ_OFFSET, seq + 1)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def set_zappi(self, status, power, added):
+        """status is the zappi status code, power in W, added in Wh"""
+        self._update(ZAPPI_OFFSET, ZAPPI.pack(time.time(), status, power, added, 0))
+
+    def set_dispatches(self, slots):
+        """slots are 4-tuples as returned by IOG.chargingSlots()
+        Only the last MAX_DISPATCHES (by end time) are kept."""
+        slots = slots[-MAX_DISPATCHES:]
+        data = DISPATCHES.pack(time.time(), len(slots), 0)
+        for start, end, delta, completed in slots:
+            data += DISPATCH.pack(start.timestamp(), end.timestamp(), float(delta), bool(completed))
+        self._update(DISPATCHES_OFFSET, data)
+
+class SensorReader:
+    """used by the monitor. The file is mapped once, and poll() is cheap
+    unless something has changed."""
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_PATH
+        self.mm = None
+        self.seq = None
+
+    def poll(self):
+        """Returns a Sensors snapshot if anything has changed since the
+        last call, else None"""
+        if self.mm is None:
+            # map it on first use. Opening it creates it if there's no
+            # writer yet, which saves checking again every time.
+            fd, self.mm = _open(self.path)
+            os.close(fd)    # the mapping stays valid
+
+        seq, = SEQ.unpack_from(self.mm, SEQ_OFFSET)
+        if seq == self.seq:
+            return None
+
+        for attempt in range(100):
+            if seq & 1 == 0:
+                data = self.mm[:SIZE]
+                again, = SEQ.unpack_from(self.mm, SEQ_OFFSET)
+                if again == seq:
+                    break
+                seq = again
+            else:
+                # a writer is busy - it won't be for long
+                time.sleep(0.001)
+                seq, = SEQ.unpack_from(self.mm, SEQ_OFFSET)
+        else:
+            return None     # try again next cycle
+
+        self.seq = seq
+        magic, version, _, _ = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            return None
+
+        zappi = Zappi(*ZAPPI.unpack_from(data, ZAPPI_OFFSET)[:4])
+        updated, count, _ = DISPATCHES.unpack_from(data, DISPATCHES_OFFSET)
+        dispatches = []
+        offset = DISPATCHES_OFFSET + DISPATCHES.size
+        for _ in range(min(count, MAX_DISPATCHES)):
+            start, end, delta, completed = DISPATCH.unpack_from(data, offset)
+            dispatches.append(Dispatch(datetime.fromtimestamp(start), datetime.fromtimestamp(end),
+                                       delta, bool(completed)))
+            offset += DISPATCH.size
+        return Sensors(seq, zappi, updated, dispatches)
+
+if __name__ == "__main__":
+    # dump the current contents
+    print(SensorReader().poll())
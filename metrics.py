@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Lightweight metrics for the monitor loop: counters, gauges and
+# histograms, rendered in the Prometheus text format.
+# They can be dumped to a file (eg for node_exporter's textfile
+# collector) and/or served over http for scraping.
+#
+# A registry can carry constant labels (eg which inverter), and
+# RegistryGroup renders several registries with the same metrics
+# (one per inverter) as one set.
+
+import asyncio
+import os
+
+class Metric:
+    def __init__(self, name, help, kind):
+        self.name = name
+        self.help = help
+        self.kind = kind
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+    def render(self, extra=None):
+        return self.header() + self.samples(extra)
+
+def _labels(label, value, extra=None):
+    pairs = []
+    if value is not None:
+        pairs.append(f'{label}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter(Metric):
+    """monotonic count, optionally broken down by a single label"""
+
+    def __init__(self, name, help, label=None):
+        super().__init__(name, help, 'counter')
+        self.label = label
+        self.values = {}
+
+    def inc(self, value=None, amount=1):
+        self.values[value] = self.values.get(value, 0) + amount
+
+    def samples(self, extra=None):
+        lines = []
+        for value, count in sorted(self.values.items(), key=lambda kv: str(kv[0])):
+            lines.append(f'{self.name}{_labels(self.label, value, extra)} {count}')
+        return lines
+
+class Gauge(Metric):
+    def __init__(self, name, help):
+        super().__init__(name, help, 'gauge')
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, extra=None):
+        return [f'{self.name}{_labels(None, None, extra)} {self.value}']
+
+class Histogram(Metric):
+    """distribution of observed values, with fixed bucket boundaries"""
+
+    def __init__(self, name, help, buckets):
+        super().__init__(name, help, 'histogram')
+        self.buckets = sorted(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def samples(self, extra=None):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append(f'{self.name}_bucket{_labels("le", bound, extra)} {cumulative}')
+        lines.append(f'{self.name}_bucket{_labels("le", "+Inf", extra)} {self.count}')
+        lines.append(f'{self.name}_sum{_labels(None, None, extra)} {self.sum}')
+        lines.append(f'{self.name}_count{_labels(None, None, extra)} {self.count}')
+        return lines
+
+# bucket boundaries (seconds) suitable for modbus round trips
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+
+class Registry:
+    def __init__(self, labels=None):
+        """labels is a dict of constant labels for all the metrics"""
+        self.metrics = []
+        self.extra = ','.join(f'{k}="{v}"' for k, v in labels.items()) if labels else None
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self._add(Counter(name, help, label))
+
+    def gauge(self, name, help):
+        return self._add(Gauge(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(self.extra))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """write to a file, atomically so a reader never sees half of it"""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    async def serve(self, port):
+        """serve the metrics over http, for scraping"""
+
+        async def handle(reader, writer):
+            try:
+                # don't care what was asked for - there's only one thing to serve
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                body = self.render().encode()
+                writer.write(b'HTTP/1.0 200 OK\r\n'
+                             b'Content-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, port=port)
+
+class RegistryGroup(Registry):
+    """several registries with the same metrics (but different constant
+    labels), rendered together, with each metric's header only once"""
+
+    def __init__(self, registries):
+        super().__init__()
+        self.registries = registries
+
+    def render(self):
+        lines = []
+        for metrics in zip(*(r.metrics for r in self.registries)):
+            lines.extend(metrics[0].header())
+            for r, metric in zip(self.registries, metrics):
+                lines.extend(metric.samples(r.extra))
+        return '\n'.join(lines) + '\n'
@@ -11,113 +11,182 @@
 # just trying to cover house load.
 
 import asyncio
+from collections import namedtuple
 from datetime import datetime
 from gzip import GzipFile
 import logging
+import math
+import os
 import sys
+import time
 
 from givenergy_modbus.client.client import Client
 from givenergy_modbus.model.plant import Plant
 from givenergy_modbus.model.register import HR, IR
+from givenergy_modbus.pdu import ReadHoldingRegistersRequest, ReadInputRegistersRequest
+
+from metrics import Registry, RegistryGroup
+from refreshplan import RefreshPlanner, HR_FIELDS
+from ringbuf import SampleRing
+from timeslots import SlotIndex, SLOT_REGISTERS
+
+# shared with the scripts in bin/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin'))
+from response import ResponseModel, DEFAULT_PATH as RESPONSE_PATH, SLOPE_RANGE
+from sensors import SensorReader
 
 _logger = logging.getLogger(__name__)
 
-def remaining(now, ts):
-    # time until end of timeslot
-
-    t = ts.start
-    ss = t.hour * 3600 + t.minute * 60 + ts.start.second
-    t = ts.end
-    es = t.hour * 3600 + t.minute * 60 + ts.start.second
-    t = now
-    ts = t.hour * 3600 + t.minute * 60 + ts.start.second
-
-    # now is assumed to be in the timeslot
-    if ts < es:
-        return es - ts
-    elif ss < es:
-        # ts does not wrap midnight
-        return 0
-    else:
-        # ts wraps midnight, so it's seconds until midnight
-        # plus seconds until end
-        return 3600 - ss + es
-        
+# holding registers which wake the control loop when they change:
+# charge limit, discharge limit, pause mode, and the slot times
+WAKE_REGISTERS = {111, 112, 318} | SLOT_REGISTERS
+
+# after being woken, wait this long (seconds) for any other
+# updates in the same burst
+COALESCE = 0.5
 
 class MyPlant(Plant):
 
     # we are interested in when dp changes
     dpchanged = None
 
+    # where the time comes from (replay.py substitutes a simulated clock)
+    clock = datetime.now
+
+    # set by the monitor to an asyncio.Event, to be woken early
+    wakeup = None
+
+    # whether the controller needs to rebuild its index of the timeslots
+    slots_changed = True
+
+    # the slot registers as last seen, {reg: value}, to tell when they
+    # actually change (rather than just being read again)
+    slot_values = None
+
+    # the RefreshPlanner to tell about changes, if any
+    reads = None
+
+    # writes by the monitor itself, as {reg: value}, until the inverter
+    # echoes them back
+    written = None
+
+    def expect(self, reg, value):
+        """the monitor is about to write value to reg"""
+        if self.written is None:
+            self.written = {}
+        self.written[int(reg)] = value
+
     def registers_updated(self, reg, count, values):
+        if self.slot_values is None:
+            self.slot_values = {}
+        for r, value in zip(range(int(reg), int(reg) + count), values):
+            if r in SLOT_REGISTERS and self.slot_values.get(r) != value:
+                self.slot_values[r] = value
+                self.slots_changed = True
         if count == 1:
             # This is *usually* because a register has changed.
             # But note that retrieving a value through the cloud API does
             # seem to do a read of a single register.
             print(f'holding reg {reg} now {values[0]}')
+            if self.written and self.written.get(int(reg)) == values[0]:
+                # just our own write coming back: nothing to react to
+                del self.written[int(reg)]
+                return
             if int(reg) == 112:
-                self.dpchanged = datetime.now()
+                self.dpchanged = self.clock()
+            if self.reads is not None:
+                self.reads.changed(reg)
+            if int(reg) in WAKE_REGISTERS and self.wakeup is not None:
+                self.wakeup.set()
             
-async def monitor(zf = None):
+# The tunable constants of the control law (see tuner.py)
+Params = namedtuple('Params', [
+    'factor',       # weight of the latest reading in the fast moving averages
+    'decay',        # how fast the sawtooth decays
+    'high',         # gma above this means increase cp
+    'clip',         # instantaneous gen above this means a bigger jump
+    'target',       # when reducing cp, aim to get gdecay back to here
+    'step',         # W per unit of charge limit (unless there's a response model)
+    'delay_base',   # default delay is (delay_base - solar) / delay_slope
+    'delay_slope',
+])
+
+# the most the charge limit register takes
+MAX_CP = 50
+
+PARAMS = Params(factor=.75, decay=.95, high=4800, clip=4900, target=4500,
+                step=97.5, delay_base=5555, delay_slope=18.5)
+
+class Controller:
     """
-    Monitor the system for clipping, and adjust battery
-    charging power as required.
+    The control law. Given the latest state of the plant, decide what
+    registers to write, and how long to wait before looking again.
+    Kept separate from the modbus client so that it can also be driven
+    from a recording (see replay.py) or a simulation (siminverter.py).
     """
-    # Only interested in a subset of registers, and no batteries
-    registers = {IR(0),  HR(0), HR(60), HR(300)}
-    plant = MyPlant(registers=registers, num_batteries=0)
-    client = Client(sys.argv[1], 8899, recorder=zf, plant=plant)
-
-    # moving averages for solar, generation export, and battery
-    sma = 0
-    gma = 0
-    ema = 0
-    bma = 0
-
-    # saw-tooth decaying things for solar and generation
-    sdecay = 0
-    gdecay = 0
-
-    # seconds since last adjustment.
-    # Use -60 initially to avoid doing anything until moving averages
-    # have settled down
-    elapsed = -60
-
-    await client.connect()
-    
-    # "%5d %6.1f %6.1f  %5d %6.1f %6.1f   %5d %5d %6.1f %6.1f  %s %s %d %d"
-    # solar, sma, sdecay,
-    # gen, gma, gdecay,
-    # export, ema,
-    # battery, bma, inverter.temp_inverter_heatsink,
-    #                  cp, paused, elapsed, delay)
-    print("-------solar-------   --------gen-------    --export--   ---------battery----------   -temp- -time-")
-
-    # first time through, the refresh includes the HR's
-    # subsequently, set to False to include only the IR subset
-    # Note that we have to repeat the register subset since other
-    # registers might appear if other applications discover them.
-    full = True
-    while True:
-        await client.refresh_plant(full_refresh=full, registers = registers)
-        full = False
 
-        inverter = plant.inverter
+    def __init__(self, plant, params=PARAMS, response=None, log=_logger):
+        self.plant = plant
+        self.params = params
+        self.log = log
+        # how the battery responds to cp (see bin/response.py). Without
+        # one, it's assumed to be params.step per unit.
+        self.response = response
+
+        # moving averages for solar, generation export, and battery
+        self.sma = 0
+        self.gma = 0
+        self.ema = 0
+        self.bma = 0
+
+        # saw-tooth decaying things for solar and generation
+        self.sdecay = 0
+        self.gdecay = 0
+
+        # seconds since last adjustment.
+        # Use -60 initially to avoid doing anything until moving averages
+        # have settled down
+        self.elapsed = -60
+        self.last = None    # time of previous step
+
+        # index of the inverter's timeslots, rebuilt when they change
+        self.slots = None
+
+    def step(self, now):
+        """
+        Run one cycle of the control law, at time now.
+        Returns (writes, delay) where writes is a list of
+        (register name, value) to be written, and delay is
+        the number of seconds until the next cycle.
+        """
+
+        # cycles don't always last as long as requested (the loop can
+        # be woken early), so measure it
+        if self.last is not None:
+            self.elapsed += (now - self.last).total_seconds()
+        self.last = now
+
+        p = self.params
+        inverter = self.plant.inverter
+        if self.slots is None or getattr(self.plant, 'slots_changed', False):
+            self.slots = SlotIndex.from_inverter(inverter)
+            self.plant.slots_changed = False
+        active = self.slots.active(now)
         solar = inverter.p_pv1 + inverter.p_pv2
         gen = inverter.p_inverter_out
         export = inverter.p_grid_out
         battery = inverter.p_battery
 
         # use a very fast ma to filter spikes
-        factor = .75  #  if gen > gma else .1
-        sma = solar*factor + sma*(1-factor)
-        gma = gen*factor + gma*(1-factor)
-        ema = export*factor + ema*(1-factor)
-        bma = battery*factor + bma*(1-factor)
+        factor = p.factor  #  if gen > gma else .1
+        self.sma = solar*factor + self.sma*(1-factor)
+        self.gma = gen*factor + self.gma*(1-factor)
+        self.ema = export*factor + self.ema*(1-factor)
+        self.bma = battery*factor + self.bma*(1-factor)
 
         # then a sawtooth sort of thing
-        sdecay = sma if sma >= sdecay else sdecay * .95 + sma * .05
-        gdecay = gma if gma >= gdecay else gdecay * .95 + gma * .05
+        self.sdecay = self.sma if self.sma >= self.sdecay else self.sdecay * p.decay + self.sma * (1-p.decay)
+        self.gdecay = self.gma if self.gma >= self.gdecay else self.gdecay * p.decay + self.gma * (1-p.decay)
 
         # choose a default refresh time.
         # 30s seems a good choice when solar is in the vicinity of 5kW
@@ -126,9 +195,8 @@ async def monitor(zf = None):
         #  300.27 when solar is 0
         #   30 when solar is 5000
 
-        sun = solar if solar > sdecay else sdecay
-        delay = 30 if sun > 5000 else (5555 - sun) / 18.5
-        assert delay >= 30
+        sun = solar if solar > self.sdecay else self.sdecay
+        delay = max(30, (p.delay_base - sun) / p.delay_slope)
 
         # for charging, we control two parameters : pause-battery-charging, and charging-power
         # charging power is a percentage of battery size,
@@ -136,13 +204,17 @@ async def monitor(zf = None):
         # extra (so 250W when cp is 0).
         # Data-fitting suggests that power = x * 97.5 + 185, but
         # when x = 0, it behaves like 1.
-        # Could also think of it as approx 95 * (x + 2)
+        # The response model keeps that fit up to date from what we
+        # see, and its slope is what each unit of cp is worth.
         # When paused, it tends to show as charging at 28W or so.
         # (Or -28, since the input register is battery discharge power.)
         #
         # discharge power is a bit more regular:
         #  dp=0 gives discharge power of around 55W
         #  otherwise it's about (dp*97.5W)
+        step = p.step
+        if self.response is not None and SLOPE_RANGE[0] <= self.response.charge.slope <= SLOPE_RANGE[1]:
+            step = self.response.charge.slope
 
         paused = inverter.battery_pause_mode
         dp = inverter.battery_discharge_limit
@@ -156,22 +228,19 @@ async def monitor(zf = None):
         # Now figure out what we need to change.
         delta = 0
         forced_discharge = False
-        requests = []
-        commands = client.commands
+        writes = []
 
         # secondary job: discharge power
 
         if dp is not None and dp < 40:
             # discharge power is not at max. Should we fix that?
             # (Anything above about 36 is effectively the max of 3.6kW)
-            # I almost always use slot 1 for forced discharges.
-            ds1 = inverter.discharge_slot_1
-            now = datetime.now()
-            tnow = now.time()
+            # I almost always use slot 1 for forced discharges, but any will do.
+            slot = min((name for name in active if name.startswith('discharge_')), default=None)
 
-            forced_discharge = ds1 is not None and tnow in ds1
+            forced_discharge = slot is not None
             if forced_discharge:
-                _logger.debug("we are inside discharge slot 1")
+                self.log.debug("we are inside %s", slot)
                 # Note that the inverter tends to overshoot end of
                 # discharge by a minute or two.
                 # Fudge things by pretending that dp has only just changed,
@@ -179,109 +248,458 @@ async def monitor(zf = None):
                 # the discharge period.
                 # That way, we won't restore it until 5 mins after the end of
                 # the discharge period
-                plant.dpchanged = now
-                dt = remaining(tnow, ds1) - 30
+                self.plant.dpchanged = now
+                left = self.slots.remaining(slot, now)
+                dt = left - 30 if left > 30 else left
                 if delay > dt: delay = dt
                 ecp = -dp
-            elif plant.dpchanged is not None and (now - plant.dpchanged).total_seconds() < 300:
+            elif self.plant.dpchanged is not None and (now - self.plant.dpchanged).total_seconds() < 300:
                 # It has been changed in the last 5 minutes.
                 # Assume this is in anticipation of a forced discharge.
-                _logger.debug("dp has only recently been changed...")
+                self.log.debug("dp has only recently been changed...")
                 if delay > 30: delay = 30
-            elif bma > 200 and ema > 100:
-                _logger.info("we seem to be exporting from battery - not sure why")
+            elif self.bma > 200 and self.ema > 100:
+                self.log.info("we seem to be exporting from battery - not sure why")
                 delay = 30
             else:
-                _logger.info("setting dp back up to 50")
-                requests.append(commands.write_named_register('battery_discharge_limit', 50))
+                self.log.info("setting dp back up to 50")
+                writes.append(('battery_discharge_limit', 50))
 
 
         # clipping avoidance (charging)
-        if gma > 4800:
+        if self.gma > p.high:
             print('* need to increase cp')
-            if gen > 4900:
+            # enough to bring generation back under high in one go
+            if gen > p.clip:
                 # The instantaneous reading suggests we are close to
                 # clipping, but that hasn't yet fed into the moving average.
                 # Do a bigger jump and reduce delay
-                delta = 3
+                delta = max(3, math.ceil((gen - p.high) / step))
                 delay = 10
             else:
-                delta = 1
-        elif gen >= 4800:
+                delta = max(1, math.ceil((self.gma - p.high) / step))
+        elif gen >= p.high:
             # might just be a transient - don't increase yet
             delay = 15
-        elif gdecay >= 4500 or gen >= 4500:
+        elif self.gdecay >= p.target or gen >= p.target:
             # not time to reduce power yet. (A transient increase is not
             # a good reason increase charging power, but is a good reason
             # to defer reducing it for a cycle.)
             pass  # keep things as they are
-        elif ema < -250:
+        elif self.ema < -250:
             # we seem to be importing ???
             # defer any decisions for another cycle
-            _logger.debug('* importing %d ?', ema)
-        elif elapsed < 60:
+            self.log.debug('* importing %d ?', self.ema)
+        elif self.elapsed < 60:
             # not long since last reduction - just be patient
             pass
         elif not paused:
             # Time to reduce power. We want to get gdecay back up to around 4500
-            delta = int((gdecay - 4500) / 97.5)
+            delta = int((self.gdecay - p.target) / step)
             delay = 30
 
+        # whatever else, don't sleep through a slot starting or ending
+        edge = self.slots.next_boundary(now)
+        if edge is not None:
+            delay = min(delay, (edge - now).total_seconds())
 
-        _logger.info("%5d %6.1f %6.1f  "
+        self.log.info("%5d %6.1f %6.1f  "
                      "%5d %6.1f %6.1f  "
                      "%5d %6.1f  "
                      "%5d %6.1f %s %s %s %3d   "
                      "%4.1f   "
                      "%d %d",
-                     solar, sma, sdecay,
-                     gen, gma, gdecay,
-                     export, ema,
-                     battery, bma, cp, dp, paused, inverter.battery_percent,
+                     solar, self.sma, self.sdecay,
+                     gen, self.gma, self.gdecay,
+                     export, self.ema,
+                     battery, self.bma, cp, dp, paused, inverter.battery_percent,
                      inverter.temp_inverter_heatsink,
-                     elapsed, delay)
+                     self.elapsed, delay)
 
         if delta != 0:
             # Now turn that into an action
             # TODO: consider that there might be a forced discharge in the
             # morning. If so, would need to reduce discharge rate
 
-            _logger.debug('ecp is %d, delta is %d')
+            self.log.debug('ecp is %d, delta is %d', ecp, delta)
             wcp = ecp + delta  # wanted charging power (might be -ve)
 
-            # with this setup, charging power shouldn't need to go as high as 2kW
-            # (that would imply solar of around 7.7kW)
-            assert wcp < 25
+            # with this setup, charging power shouldn't often need to go as
+            # high as 2kW (that would imply solar of around 7.7kW), but with
+            # a shared export limit it can. Either way, stay within what
+            # the register takes.
+            if wcp > MAX_CP:
+                self.log.info("wanted cp %d: limiting to %d", wcp, MAX_CP)
+                wcp = MAX_CP
+                delta = wcp - ecp
 
             if ecp < 0 and delta > 0:
                 print("need to reduce discharge")
             elif paused and wcp > 0:
-                requests.append(commands.write_named_register('battery_pause_mode', 0))
+                writes.append(('battery_pause_mode', 0))
                 paused = False
             elif wcp <= 0 and not paused:
-                requests.append(commands.write_named_register('battery_pause_mode', 1))
+                writes.append(('battery_pause_mode', 1))
                 paused = True
 
             if wcp > 0 and ecp >= 0 and cp != wcp and not paused:
-                requests.append(commands.write_named_register('battery_charge_limit', wcp))
+                writes.append(('battery_charge_limit', wcp))
 
             if delta > 0:
                 # generation should fall - hack the moving averages.
                 # If things still look bad, they'll pop back up again quite quickly
-                gma -= delta * 100
-                gdecay -= delta * 100
+                self.gma -= delta * step
+                self.gdecay -= delta * step
+
+            # print(writes)
+            self.elapsed = 0
+
+        return writes, delay
+
+
+# how often (seconds) the sample history is flushed to disk
+FLUSH_INTERVAL = 600
+
+def record(ring, now, inverter):
+    """add the current state of the inverter to the sample history"""
+    ring.append(now,
+                inverter.p_pv1 + inverter.p_pv2,
+                inverter.p_inverter_out,
+                inverter.p_grid_out,
+                inverter.p_battery,
+                inverter.battery_charge_limit,
+                inverter.battery_discharge_limit,
+                inverter.battery_percent,
+                inverter.temp_inverter_heatsink)
+
+class LoopMetrics:
+    """the metrics collected by the monitor loop"""
+
+    def __init__(self, labels=None):
+        r = Registry(labels)
+        self.registry = r
+        # batches of writes still being waited for. The event loop only
+        # keeps weak references to tasks, so they're kept here until done
+        self.pending = set()
+        self.refresh = r.histogram('monitor_refresh_seconds', 'time taken by refresh_plant')
+        self.step = r.histogram('monitor_step_seconds', 'time taken by the control law',
+                                (0.0001, 0.001, 0.01, 0.1))
+        self.execute = r.histogram('monitor_write_ack_seconds', 'time for a batch of writes to be acknowledged')
+        self.drift = r.histogram('monitor_sleep_drift_seconds', 'how much longer than requested the sleep took',
+                                 (0.01, 0.05, 0.1, 0.5, 1, 5))
+        self.cycles = r.counter('monitor_cycles_total', 'control loop iterations')
+        self.refresh_errors = r.counter('monitor_refresh_errors_total', 'refresh_plant failures')
+        self.writes = r.counter('monitor_writes_total', 'registers written', 'register')
+        self.write_timeouts = r.counter('monitor_write_timeouts_total',
+                                        'writes still not acknowledged after the client\'s one retry')
+        self.write_errors = r.counter('monitor_write_errors_total', 'writes which failed for other reasons')
+        self.delay = r.gauge('monitor_delay_seconds', 'the most recent requested delay')
+        self.wakeups = r.counter('monitor_wakeups_total', 'cycles started early by a register change')
+        self.read_requests = r.counter('monitor_read_requests_total', 'modbus read requests made')
+        self.read_bytes = r.counter('monitor_read_bytes_total', 'bytes of modbus reads (approx)')
+        # gauges, since a cycle which reads holding registers saves
+        # less than nothing (see refreshplan.py)
+        self.read_requests_saved = r.gauge('monitor_read_requests_saved',
+                                           'read requests saved so far, compared with reading the whole IR block every cycle')
+        self.read_bytes_saved = r.gauge('monitor_read_bytes_saved',
+                                        'bytes saved so far, compared with reading the whole IR block every cycle')
+        self.gen_p95 = r.gauge('monitor_gen_p95_watts', '95th percentile of generation over the last 5 minutes')
+
+    def reads(self, planner, requests, nbytes):
+        """record what a refresh read, and the RefreshPlanner's
+        savings so far"""
+        self.read_requests.inc(amount=requests)
+        self.read_bytes.inc(amount=nbytes)
+        self.read_requests_saved.set(planner.requests_saved)
+        self.read_bytes_saved.set(planner.bytes_saved)
+
+    def executed(self, t0, results):
+        """record the outcome of client.execute()"""
+        self.execute.observe(time.monotonic() - t0)
+        for result in results or ():
+            if isinstance(result, asyncio.TimeoutError):
+                self.write_timeouts.inc()
+            elif isinstance(result, BaseException):
+                self.write_errors.inc()
+
+    def track(self, t0, result):
+        """client.execute() may hand back something to wait for, or
+        the results directly. Either way, record them without holding up
+        the loop."""
+        if asyncio.isfuture(result) or asyncio.iscoroutine(result):
+            future = asyncio.ensure_future(result)
+            self.pending.add(future)
+
+            def done(f):
+                self.pending.discard(f)
+                if f.cancelled():
+                    return
+                e = f.exception()
+                if e is not None:
+                    self.write_errors.inc()
+                else:
+                    self.executed(t0, f.result())
+            future.add_done_callback(done)
+            return future
+        self.executed(t0, result)
+        return result
+
+# AC output of one inverter (W). The thresholds in Params are relative to it.
+AC_LIMIT = 5000
+
+# with several inverters, the least time (seconds) between refreshes of
+# any two of them
+STAGGER = 2.0
+
+def limit_params(params, cap):
+    """the control law's thresholds moved down, to keep generation under
+    cap rather than AC_LIMIT"""
+    offset = min(0, cap - AC_LIMIT)
+    return params._replace(high=params.high + offset, clip=params.clip + offset,
+                           target=params.target + offset)
+
+class Prefixed(logging.LoggerAdapter):
+    """log messages for one of several inverters"""
+
+    def process(self, msg, kwargs):
+        return f'{self.extra["name"]}: {msg}', kwargs
+
+class Unit:
+    """
+    One inverter: its connection, plant state, control state and
+    history. With a single inverter, name is '' and all the files are
+    as they always were; otherwise they have the name added.
+    """
 
-            # print(requests)
-            elapsed = 0
+    def __init__(self, host, port=8899, name='', recorder=None):
+        self.name = name
+        # Only interested in a subset of registers, and no batteries.
+        # After the first refresh, only the parts of them which are
+        # needed are read (see refreshplan.py)
+        self.registers = {IR(0),  HR(0), HR(60), HR(300)}
+        self.reads = RefreshPlanner()
+        self.plant = MyPlant(registers=self.registers, num_batteries=0)
+        self.plant.reads = self.reads
+        self.client = Client(host, port, recorder=recorder, plant=self.plant)
+
+        suffix = f'.{name}' if name else ''
+        self.response_path = RESPONSE_PATH[:-len('.json')] + suffix + '.json'
+        self.response = ResponseModel.load(self.response_path)
+        log = Prefixed(_logger, {'name': name}) if name else _logger
+        self.log = log
+        self.controller = Controller(self.plant, response=self.response, log=log)
+        self.metrics = LoopMetrics({'inverter': name} if name else None)
+        self.ring = SampleRing(prefix='samples' + suffix)
+        self.ready = False      # has been refreshed at least once
+
+class Site:
+    """
+    Coordinates the inverters on one site. It spaces out their refreshes,
+    so that the data loggers aren't all polled at the same moment, and
+    shares out the site's export limit (if any) between them.
+
+    The export limit is shared as a cap on each inverter's generation, in
+    proportion to how much solar each has, and each controller's thresholds
+    are moved down to keep under its cap. The site's export is taken from
+    the first inverter, which should be the one whose CT is on the grid
+    connection.
+    """
 
-        if len(requests) > 0:
-            client.execute(requests, timeout=2.0, retries=1, return_exceptions = True)
+    def __init__(self, units, export_limit=None, stagger=STAGGER):
+        self.units = units
+        self.export_limit = export_limit
+        self.stagger = stagger if len(units) > 1 else 0
+        self.lock = asyncio.Lock()
+        self.last_refresh = 0.0
+        if len(units) == 1:
+            self.registry = units[0].metrics.registry
+        else:
+            self.registry = RegistryGroup([unit.metrics.registry for unit in units])
+
+    async def refresh(self, unit):
+        """refresh one inverter, waiting for its turn"""
+        if self.stagger:
+            async with self.lock:
+                wait = self.last_refresh + self.stagger - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self.last_refresh = time.monotonic()
+        reads = unit.reads.plan()
+        if unit.reads.first:
+            # the first time, let the library read the whole blocks, so
+            # that it can work out what it's talking to
+            await unit.client.refresh_plant(full_refresh=True, registers=unit.registers)
+        else:
+            await read(unit.client, reads)
+        requests, nbytes, _, _ = unit.reads.done(reads)
+        unit.metrics.reads(unit.reads, requests, nbytes)
+        unit.ready = True
+
+    def allocate(self):
+        """the generation cap (W) for each inverter"""
+        caps = { unit: AC_LIMIT for unit in self.units }
+        units = [unit for unit in self.units if unit.ready]
+        if self.export_limit is None or not units or not self.units[0].ready:
+            return caps
+        gen = sum(unit.plant.inverter.p_inverter_out for unit in units)
+        load = max(0, gen - self.units[0].plant.inverter.p_grid_out)
+        budget = self.export_limit + load
+        # in proportion to solar, but none can go over AC_LIMIT - so
+        # give those the most they can take, and share out what's left
+        while units:
+            solar = { unit: max(unit.controller.sma, 1) for unit in units }
+            total = sum(solar.values())
+            full = [unit for unit in units if budget * solar[unit] / total >= AC_LIMIT]
+            if not full:
+                for unit in units:
+                    caps[unit] = budget * solar[unit] / total
+                break
+            for unit in full:
+                budget -= AC_LIMIT
+                units.remove(unit)
+        return caps
+
+async def read(client, reads):
+    """make a list of refreshplan.Reads. The plant is updated from the
+    responses as they arrive, like any other."""
+    requests = [(ReadInputRegistersRequest if r.bank == 'IR' else ReadHoldingRegistersRequest)
+                (base_register=r.base, register_count=r.count) for r in reads]
+    result = client.execute(requests, timeout=2.0, retries=1, return_exceptions=True)
+    if asyncio.isfuture(result) or asyncio.iscoroutine(result):
+        result = await result
+    for r in result or ():
+        if isinstance(r, BaseException):
+            raise r
+
+async def run(unit, site, sensors, offset=0):
+    """the control loop for one inverter"""
+    plant, client, controller = unit.plant, unit.client, unit.controller
+    metrics, ring, response = unit.metrics, unit.ring, unit.response
+    plant.wakeup = asyncio.Event()
+    flushed = time.monotonic()
+
+    # start the inverters at different times, so they don't run in lockstep
+    await asyncio.sleep(offset)
+    await client.connect()
 
-        await asyncio.sleep(delay)
-        elapsed += delay  # only needs to be approx
+    # The first refresh includes the HR's, subsequently only what
+    # the RefreshPlanner says is needed.
+    while True:
+        t0 = time.monotonic()
+        try:
+            await site.refresh(unit)
+        except Exception:
+            metrics.refresh_errors.inc()
+            raise
+        metrics.refresh.observe(time.monotonic() - t0)
+        metrics.cycles.inc()
+
+        update = sensors.poll()
+        if update is not None:
+            for d in update.dispatches:
+                _logger.info("dispatch %s - %s %.1fkWh%s", d.start, d.end, d.delta,
+                             " (completed)" if d.completed else "")
+
+        now = datetime.now()
+        inverter = plant.inverter
+        record(ring, now, inverter)
+        response.observe(inverter.battery_charge_limit, inverter.battery_discharge_limit,
+                         inverter.battery_pause_mode, inverter.p_battery, inverter.p_grid_out,
+                         inverter.battery_percent)
+        metrics.gen_p95.set(ring.percentile('gen', 5, 95))
+        if time.monotonic() - flushed > FLUSH_INTERVAL:
+            ring.flush()
+            response.save(unit.response_path)
+            flushed = time.monotonic()
+
+        controller.params = limit_params(PARAMS, site.allocate()[unit])
+
+        t0 = time.monotonic()
+        writes, delay = controller.step(now)
+        metrics.step.observe(time.monotonic() - t0)
+        metrics.delay.set(delay)
+
+        if len(writes) > 0:
+            commands = client.commands
+            requests = [commands.write_named_register(name, value) for name, value in writes]
+            for name, value in writes:
+                metrics.writes.inc(name)
+                unit.reads.written(name)
+                for reg in HR_FIELDS.get(name, ()):
+                    plant.expect(reg, value)
+            t0 = time.monotonic()
+            metrics.track(t0, client.execute(requests, timeout=2.0, retries=1, return_exceptions = True))
+
+        site.registry.dump('/tmp/monitor.prom')
+
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait_for(plant.wakeup.wait(), delay)
+            # coalesce a burst of changes into one cycle
+            await asyncio.sleep(COALESCE)
+            metrics.wakeups.inc()
+        except asyncio.TimeoutError:
+            metrics.drift.observe(time.monotonic() - t0 - delay)
+        plant.wakeup.clear()
+
+async def monitor(units, export_limit=None):
+    """
+    Monitor the system for clipping, and adjust battery
+    charging power as required.
+
+    Each of units (one per inverter) runs its own control loop,
+    concurrently, coordinated by a Site.
+
+    Rather than just sleeping between cycles, the loop is also woken
+    as soon as the inverter reports a change to one of WAKE_REGISTERS
+    (eg dp being changed via the app), with the adaptive delay as
+    a fallback.
+
+    Metrics for the loop are written to /tmp/monitor.prom each cycle,
+    and served over http if MONITOR_METRICS_PORT is set.
+
+    Each cycle's readings are kept in a SampleRing, flushed every
+    FLUSH_INTERVAL to /tmp/samples.<date>.bin. They also go into the
+    response model, which is saved at the same time for the scripts.
+    """
+    site = Site(units, export_limit)
+
+    # data passed in from external scripts (IOG dispatches, zappi)
+    sensors = SensorReader()
+
+    if 'MONITOR_METRICS_PORT' in os.environ:
+        await site.registry.serve(int(os.environ['MONITOR_METRICS_PORT']))
+
+    # "%5d %6.1f %6.1f  %5d %6.1f %6.1f   %5d %5d %6.1f %6.1f  %s %s %d %d"
+    # solar, sma, sdecay,
+    # gen, gma, gdecay,
+    # export, ema,
+    # battery, bma, inverter.temp_inverter_heatsink,
+    #                  cp, paused, elapsed, delay)
+    print("-------solar-------   --------gen-------    --export--   ---------battery----------   -temp- -time-")
+
+    async def isolated(unit, offset):
+        # one inverter failing shouldn't stop the others
+        try:
+            await run(unit, site, sensors, offset)
+        except Exception:
+            unit.log.exception('control loop failed')
+            unit.ready = False
+            raise
+
+    # spread the first cycles evenly over the shortest delay
+    spacing = 30 / len(units)
+    results = await asyncio.gather(*(isolated(unit, n * spacing) for n, unit in enumerate(units)),
+                                   return_exceptions=True)
+    # only get here once every loop has failed
+    raise results[0]
 
 if __name__ == "__main__":
 
+    # monitor.py HOST[:PORT] ...
+    # one data logger per inverter. MONITOR_EXPORT_LIMIT (W) is the
+    # site's export limit, to be shared between them.
+
     now = datetime.now()
     tstamp = now.strftime("%Y%m%d-%H%M")
 
@@ -298,5 +716,12 @@ if __name__ == "__main__":
 
     _logger.setLevel(logging.INFO)
 
-    zf = GzipFile(filename="/tmp/capture." + tstamp + ".gz", mode="wb")
-    asyncio.run(monitor(zf))
+    units = []
+    for arg in sys.argv[1:]:
+        host, _, port = arg.partition(':')
+        name = host if len(sys.argv) > 2 else ''
+        suffix = f'.{name}' if name else ''
+        zf = GzipFile(filename="/tmp/capture." + tstamp + suffix + ".gz", mode="wb")
+        units.append(Unit(host, int(port or 8899), name, zf))
+    limit = os.environ.get('MONITOR_EXPORT_LIMIT')
+    asyncio.run(monitor(units, float(limit) if limit else None))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Works out which modbus reads the monitor needs each cycle.
+#
+# The inverter's registers are read in blocks of 60, but the control law
+# only looks at a handful of fields: the powers, SoC and temperature
+# from the input registers, which change all the time, and the limits,
+# pause mode and timeslots from the holding registers, which hardly ever
+# do (and when they do, the inverter usually tells us). So each cycle
+# it reads just the span of input registers the fields are in, and a
+# span of holding registers only when
+#  - it's the first cycle (when whole blocks are read, so that the
+#    library can see what sort of inverter it is)
+#  - a register in it has changed (someone using the app, or a write by
+#    the monitor itself), since others nearby may have changed with it
+#  - it hasn't been read for HR_INTERVAL, just in case
+#
+# It counts the requests and bytes it reads, and those saved compared
+# with what the monitor read before: after the first full refresh, the
+# whole block of input registers, and nothing else, every cycle. That
+# baseline never re-read the holding registers, so a cycle which reads
+# some saves less than nothing, and the savings can go down as well
+# as up.
+#
+#  refreshplan.py [cycles]
+# prints the reads it would plan, and what that saves.
+
+from collections import namedtuple
+import sys
+import time
+
+BLOCK = 60              # registers per block
+HR_INTERVAL = 1800      # seconds between reads of unchanged holding registers
+
+# bytes per read besides the register values: the request frame, plus
+# the response's header and checksum (roughly - it varies a little
+# between firmware versions)
+FRAME_BYTES = 80
+
+# the input registers the monitor uses
+IR_FIELDS = {
+    'p_pv1': 18,
+    'p_pv2': 20,
+    'p_inverter_out': 24,
+    'p_grid_out': 30,
+    'temp_inverter_heatsink': 41,
+    'p_battery': 52,
+    'battery_percent': 59,
+}
+
+# and the holding registers
+HR_FIELDS = {
+    'charge_slot_2': (31, 32),
+    'discharge_slot_2': (44, 45),
+    'discharge_slot_1': (56, 57),
+    'charge_slot_1': (94, 95),
+    'battery_charge_limit': (111,),
+    'battery_discharge_limit': (112,),
+    'battery_pause_mode': (318,),
+    'battery_pause_slot_1': (319, 320),
+}
+
+# a read of count registers from base, in bank 'IR' or 'HR'
+Read = namedtuple('Read', 'bank base count')
+
+def spans(registers):
+    """the smallest read in each block which covers the registers,
+    as {(bank, block base): Read}"""
+    blocks = {}
+    for bank, reg in registers:
+        block = reg // BLOCK * BLOCK
+        lo, hi = blocks.get((bank, block), (reg, reg))
+        blocks[(bank, block)] = (min(lo, reg), max(hi, reg))
+    return { key: Read(key[0], lo, hi - lo + 1) for key, (lo, hi) in blocks.items() }
+
+class RefreshPlanner:
+    """decides what to read each cycle"""
+
+    def __init__(self, ir_fields=IR_FIELDS, hr_fields=HR_FIELDS, interval=HR_INTERVAL):
+        registers = [('IR', reg) for reg in ir_fields.values()]
+        registers += [('HR', reg) for regs in hr_fields.values() for reg in regs]
+        self.spans = spans(registers)
+        self.interval = interval
+        self.first = True
+        self.stale = { key for key in self.spans if key[0] == 'HR' }
+        # the steady-state refresh being compared with: each IR block, in full
+        self.baseline = sum(1 for key in self.spans if key[0] == 'IR')
+        self.read_at = {}   # (bank, block): monotonic time of last read
+
+        # totals, for the metrics
+        self.requests = 0
+        self.bytes = 0
+        self.requests_saved = 0
+        self.bytes_saved = 0
+
+    def changed(self, reg):
+        """a holding register has changed"""
+        key = ('HR', int(reg) // BLOCK * BLOCK)
+        if key in self.spans:
+            self.stale.add(key)
+
+    def written(self, name):
+        """the monitor has written one of the fields"""
+        for reg in HR_FIELDS.get(name, ()):
+            self.changed(reg)
+
+    def plan(self, now=None):
+        """the reads for this cycle"""
+        if now is None:
+            now = time.monotonic()
+        reads = []
+        for key, span in sorted(self.spans.items()):
+            last = self.read_at.get(key)
+            if key[0] == 'HR' and key not in self.stale and last is not None and now - last < self.interval:
+                continue
+            reads.append(Read(key[0], key[1], BLOCK) if self.first else span)
+        return reads
+
+    def done(self, reads, now=None):
+        """the reads were made successfully. Returns the number of
+        requests and bytes, and those saved, for this cycle."""
+        first = self.first
+        if now is None:
+            now = time.monotonic()
+        for read in reads:
+            key = (read.bank, read.base // BLOCK * BLOCK)
+            self.read_at[key] = now
+            self.stale.discard(key)
+        self.first = False
+        requests = len(reads)
+        nbytes = sum(FRAME_BYTES + 2 * read.count for read in reads)
+        if first:
+            # the same full refresh as before
+            requests_saved = bytes_saved = 0
+        else:
+            requests_saved = self.baseline - requests
+            bytes_saved = self.baseline * (FRAME_BYTES + 2 * BLOCK) - nbytes
+        self.requests += requests
+        self.bytes += nbytes
+        self.requests_saved += requests_saved
+        self.bytes_saved += bytes_saved
+        return requests, nbytes, requests_saved, bytes_saved
+
+def main():
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    planner = RefreshPlanner()
+    # a cycle every 30s, with a register change now and then
+    for n in range(cycles):
+        now = n * 30.0
+        if n % 40 == 20:
+            planner.changed(112)
+        reads = planner.plan(now)
+        if n < 3 or any(read.bank == 'HR' for read in reads):
+            print(f'{n:4d} ' + ' '.join(f'{r.bank}({r.base}+{r.count})' for r in reads))
+        planner.done(reads, now)
+    print(f'{planner.requests} requests, {planner.bytes} bytes; '
+          f'saved {planner.requests_saved} requests, {planner.bytes_saved} bytes')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Replay a capture recorded by monitor.py (/tmp/capture.<tstamp>.gz)
+# through the control law, offline, and report the decisions it would
+# have made.
+#
+#  replay.py [--speed N] [--start YYYYmmdd-HHMM] capture.gz
+#
+# The capture is the raw stream of frames received from the inverter.
+# It doesn't contain any timestamps, so the replay runs against a
+# simulated clock: it starts at the time in the capture's filename (or
+# --start), and each cycle advances it by the delay the controller asked
+# for. Each refresh of the input registers in the capture is taken as one
+# cycle of the original monitor loop, so with unchanged settings the
+# clock tracks the original run.
+#
+# Note that the state in the capture reflects what the original monitor
+# actually did, not what the replayed controller would have done - it's
+# a way to see (and count) decisions, not a simulation. See siminverter.py
+# for that.
+#
+# By default it runs as fast as possible. --speed N sleeps for
+# 1/N of each delay, so --speed 1 is real-time.
+
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta
+from gzip import GzipFile
+import logging
+import os
+import re
+import time
+
+from givenergy_modbus.framer import ClientFramer
+from givenergy_modbus.model.register import HR, IR
+from givenergy_modbus.pdu import ReadInputRegistersResponse
+
+from monitor import Controller, MyPlant
+from refreshplan import IR_FIELDS
+
+_logger = logging.getLogger(__name__)
+
+class SimulatedClock:
+    """stands in for datetime.now()"""
+
+    def __init__(self, start):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += timedelta(seconds=seconds)
+
+def frames(filename, chunk=65536):
+    """generator which yields the decoded PDUs from a capture"""
+    framer = ClientFramer()
+    with GzipFile(filename, mode='rb') as zf:
+        while True:
+            data = zf.read(chunk)
+            if not data:
+                break
+            try:
+                yield from framer.decode(data)
+            except Exception as e:
+                # a damaged frame shouldn't stop the whole replay
+                _logger.warning('decode failed: %s', e)
+
+# the first input register the controller uses
+FIRST_IR = min(IR_FIELDS.values())
+
+def replay(filename, start, speed=None):
+    """Run the capture through the controller. Returns a Counter of writes
+    by register name, and the number of cycles."""
+    registers = {IR(0), HR(0), HR(60), HR(300)}
+    plant = MyPlant(registers=registers, num_batteries=0)
+    clock = SimulatedClock(start)
+    plant.clock = clock
+    controller = Controller(plant)
+
+    writes = Counter()
+    cycles = 0
+    for pdu in frames(filename):
+        try:
+            plant.update(pdu)
+        except Exception as e:
+            _logger.warning('update failed: %s', e)
+            continue
+
+        # each refresh of the input registers the controller uses is a
+        # cycle: the whole first block, or (since refreshplan.py) just the
+        # span of IR_FIELDS
+        if not isinstance(pdu, ReadInputRegistersResponse) or pdu.base_register > FIRST_IR:
+            continue
+
+        try:
+            decisions, delay = controller.step(clock())
+        except (TypeError, AttributeError):
+            # plant not fully populated yet
+            continue
+        cycles += 1
+        for name, value in decisions:
+            print(clock().strftime('%H:%M:%S'), name, value)
+            writes[name] += 1
+        clock.advance(delay)
+        if speed:
+            time.sleep(delay / speed)
+    return writes, cycles
+
+def start_time(filename):
+    """pick the start time out of capture.<YYYYmmdd-HHMM>.gz"""
+    m = re.search(r'(\d{8}-\d{4})', os.path.basename(filename))
+    if m is None:
+        return datetime.now()
+    return datetime.strptime(m.group(1), '%Y%m%d-%H%M')
+
+def main():
+    parser = argparse.ArgumentParser(description='replay a monitor.py capture through the control law')
+    parser.add_argument('capture')
+    parser.add_argument('--speed', type=float, help='time-scale factor (default: as fast as possible)')
+    parser.add_argument('--start', help='start time, YYYYmmdd-HHMM (default: from the filename)')
+    parser.add_argument('--verbose', action='store_true', help='show the per-cycle log')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('monitor').setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    start = datetime.strptime(args.start, '%Y%m%d-%H%M') if args.start else start_time(args.capture)
+    t0 = time.perf_counter()
+    writes, cycles = replay(args.capture, start, args.speed)
+    elapsed = time.perf_counter() - t0
+
+    print(f'{cycles} cycles in {elapsed:.2f}s')
+    for name, count in sorted(writes.items()):
+        print(f'{name:30s} {count:5d}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Fixed-size in-memory history of the monitor's per-cycle samples.
+#
+# Each column is a preallocated array, used as a ring buffer, so memory
+# use is bounded however long the monitor runs. Samples are flushed
+# periodically to a per-day binary file, and the most recent ones can be
+# queried over a time window (min / max / percentile over the last N
+# minutes).
+#
+# Daily file layout (all little-endian):
+#   magic 'MONS', version (u16), number of columns (u16)
+#   for each column: name length (u8), name, array typecode (1 char)
+#   then fixed-size rows, appended as they are flushed.
+#
+#  ringbuf.py samples.YYYY-MM-DD.bin [minutes]
+# prints a summary of each column from a daily file.
+
+from array import array
+from datetime import datetime
+import os
+import struct
+import sys
+
+MAGIC = b'MONS'
+VERSION = 1
+
+# (name, array typecode). Powers in W, time is a unix timestamp.
+COLUMNS = (
+    ('time',    'd'),
+    ('solar',   'i'),
+    ('gen',     'i'),
+    ('export',  'i'),
+    ('battery', 'i'),
+    ('cp',      'h'),
+    ('dp',      'h'),
+    ('soc',     'h'),
+    ('temp',    'f'),
+)
+
+ROW = struct.Struct('<' + ''.join(typecode for _, typecode in COLUMNS))
+
+DEFAULT_DIR = '/tmp'
+
+def header():
+    data = struct.pack('<4sHH', MAGIC, VERSION, len(COLUMNS))
+    for name, typecode in COLUMNS:
+        data += struct.pack('<B', len(name)) + name.encode() + typecode.encode()
+    return data
+
+class SampleRing:
+    """the most recent capacity samples, one array per column"""
+
+    def __init__(self, capacity=4096, path=DEFAULT_DIR, prefix='samples'):
+        self.capacity = capacity
+        self.path = path
+        self.prefix = prefix
+        self.columns = { name: array(typecode, [0]) * capacity for name, typecode in COLUMNS }
+        self.head = 0       # where the next sample goes
+        self.count = 0      # number of valid samples
+        self.unflushed = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t, solar, gen, export, battery, cp, dp, soc, temp):
+        """add a sample, overwriting the oldest once full. t is a datetime
+        or a timestamp. Missing (None) values are stored as 0."""
+        if isinstance(t, datetime):
+            t = t.timestamp()
+        values = (t, solar, gen, export, battery, cp, dp, soc, temp)
+        for (name, typecode), value in zip(COLUMNS, values):
+            value = value or 0
+            self.columns[name][self.head] = float(value) if typecode in 'df' else int(value)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        # if we lap the unflushed samples, the oldest ones are lost
+        self.unflushed = min(self.unflushed + 1, self.capacity)
+
+    def _indexes(self, n):
+        """indexes of the most recent n samples, newest first"""
+        for i in range(1, min(n, self.count) + 1):
+            yield (self.head - i) % self.capacity
+
+    def window(self, name, minutes, now=None):
+        """values of a column over the last N minutes, newest first"""
+        if now is None:
+            now = self.latest()
+        elif isinstance(now, datetime):
+            now = now.timestamp()
+        since = now - minutes * 60
+        times = self.columns['time']
+        column = self.columns[name]
+        values = []
+        for i in self._indexes(self.count):
+            if times[i] < since:
+                break
+            values.append(column[i])
+        return values
+
+    def latest(self):
+        """time of the most recent sample (0 if there isn't one)"""
+        return self.columns['time'][(self.head - 1) % self.capacity] if self.count else 0
+
+    def min(self, name, minutes, now=None):
+        return min(self.window(name, minutes, now), default=None)
+
+    def max(self, name, minutes, now=None):
+        return max(self.window(name, minutes, now), default=None)
+
+    def percentile(self, name, minutes, p, now=None):
+        """nearest-rank percentile (0-100) over the window"""
+        values = sorted(self.window(name, minutes, now))
+        if not values:
+            return None
+        rank = max(1, -(-len(values) * p // 100))
+        return values[int(rank) - 1]
+
+    def filename(self, day):
+        return os.path.join(self.path, f'{self.prefix}.{day.isoformat()}.bin')
+
+    def flush(self):
+        """append any samples not yet written to the daily file(s).
+        Returns the number written."""
+        n = self.unflushed
+        if n == 0:
+            return 0
+        out = None
+        day = None
+        try:
+            # oldest first
+            for i in reversed(list(self._indexes(n))):
+                row = [self.columns[name][i] for name, _ in COLUMNS]
+                d = datetime.fromtimestamp(row[0]).date()
+                if d != day:
+                    if out is not None:
+                        out.close()
+                    day = d
+                    filename = self.filename(day)
+                    new = not os.path.exists(filename)
+                    out = open(filename, 'ab')
+                    if new:
+                        out.write(header())
+                out.write(ROW.pack(*row))
+        finally:
+            if out is not None:
+                out.close()
+        self.unflushed = 0
+        return n
+
+def load(filename):
+    """read back a daily file, as a dict of arrays (one per column)"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, ncols = struct.unpack_from('<4sHH', data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{filename} is not a samples file')
+    offset = struct.calcsize('<4sHH')
+    names = []
+    for _ in range(ncols):
+        n = data[offset]
+        names.append((data[offset+1:offset+1+n].decode(), chr(data[offset+1+n])))
+        offset += n + 2
+    row = struct.Struct('<' + ''.join(typecode for _, typecode in names))
+    columns = { name: array(typecode) for name, typecode in names }
+    # ignore any partial row at the end (eg if the monitor died mid-write)
+    end = offset + (len(data) - offset) // row.size * row.size
+    for values in row.iter_unpack(data[offset:end]):
+        for (name, _), value in zip(names, values):
+            columns[name].append(value)
+    return columns
+
+def main():
+    columns = load(sys.argv[1])
+    minutes = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    times = columns['time']
+    if len(times) == 0:
+        print('no samples')
+        return
+    # load it into a ring, to use the same queries
+    ring = SampleRing(len(times))
+    for row in zip(*columns.values()):
+        ring.append(*row)
+    if minutes is None:
+        minutes = (times[-1] - times[0]) / 60 + 1
+    print(f'{len(times)} samples, {datetime.fromtimestamp(times[0]):%H:%M:%S} to {datetime.fromtimestamp(times[-1]):%H:%M:%S}')
+    print(f"{'':8s} {'min':>8s} {'p50':>8s} {'p95':>8s} {'max':>8s}")
+    for name, _ in COLUMNS[1:]:
+        print(f'{name:8s} {ring.min(name, minutes):8.0f} {ring.percentile(name, minutes, 50):8.0f} '
+              f'{ring.percentile(name, minutes, 95):8.0f} {ring.max(name, minutes):8.0f}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+
+# A simulated inverter, for exercising monitor.py without hardware.
+#
+#  siminverter.py serve [--port 8899] [--speed N]
+#      listen for modbus (givenergy framing) connections, and serve the
+#      IR(0), HR(0), HR(60) and HR(300) blocks the monitor reads, from
+#      a physical model running at N times real-time. Writes to the
+#      charge/discharge limits and pause mode are fed back into the model.
+#
+#  siminverter.py day [--peak W] [--cloud F] [--seed N]
+#      drive the monitor's Controller directly against the model, over
+#      a whole simulated day with no networking, and report how many
+#      writes it issues, how much energy was clipped, and so on.
+#      --profile FILE takes solar and load from a recorded day instead:
+#      either a day from the data-points archive (bin/archive.py, .gedp)
+#      or the monitor's own samples (ringbuf.py, .bin).
+#
+# The model is deliberately simple:
+#  - solar is a clear-sky curve (optionally with random cloud)
+#  - the battery charges first, up to the rate set by the charge limit
+#    (about 97.5W per step, plus 185W - and 0 behaves like 1), unless paused
+#  - the rest goes out through the inverter, which clips at 5kW AC
+#  - when solar doesn't cover the load, the battery discharges to make
+#    up the difference, up to the discharge limit (dp=0 gives about 55W)
+
+import argparse
+import asyncio
+from bisect import bisect
+from collections import Counter
+from datetime import datetime, timedelta, time as dtime
+import math
+import os
+import random
+import struct
+import sys
+import time
+
+AC_LIMIT = 5000         # W
+CAPACITY = 9500         # Wh
+RESERVE = 4             # %
+STEP_W = 97.5           # W per unit of charge/discharge limit
+CHARGE_OFFSET = 185     # W
+
+# Register numbers, as used by givenergy-modbus
+IR_P_PV1 = 18
+IR_P_PV2 = 20
+IR_P_INVERTER_OUT = 24
+IR_P_GRID_OUT = 30
+IR_TEMP_HEATSINK = 41
+IR_P_BATTERY = 52
+IR_BATTERY_PERCENT = 59
+HR_ECO_MODE = 27
+HR_DISCHARGE_SLOT_1_START = 56
+HR_DISCHARGE_SLOT_1_END = 57
+HR_ENABLE_DISCHARGE = 59
+HR_CHARGE_LIMIT = 111
+HR_DISCHARGE_LIMIT = 112
+HR_PAUSE_MODE = 318
+HR_PAUSE_SLOT_START = 319
+HR_PAUSE_SLOT_END = 320
+
+class TimeSlot:
+    """minimal stand-in for the library's TimeSlot"""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def __contains__(self, t):
+        if self.start <= self.end:
+            return self.start <= t < self.end
+        return t >= self.start or t < self.end
+
+def hhmm(value):
+    """register value (eg 2230) to a time"""
+    return dtime(value // 100 % 24, value % 100 % 60)
+
+class InverterModel:
+    """
+    The physical model. It also looks enough like the library's
+    Inverter object for the Controller to use it directly.
+    """
+
+    def __init__(self, peak=6400, cloud=0.0, seed=None, soc=20, profile=None):
+        self.peak = peak
+        self.profile = profile
+        self.cloud = cloud
+        self.random = random.Random(seed)
+        self.cloudiness = 1.0
+
+        self.soc = float(soc)
+        self.hr = {
+            HR_ECO_MODE: 1,
+            HR_DISCHARGE_SLOT_1_START: 0,
+            HR_DISCHARGE_SLOT_1_END: 0,
+            HR_ENABLE_DISCHARGE: 0,
+            HR_CHARGE_LIMIT: 50,
+            HR_DISCHARGE_LIMIT: 50,
+            HR_PAUSE_MODE: 0,
+            HR_PAUSE_SLOT_START: 530,
+            HR_PAUSE_SLOT_END: 1955,
+        }
+
+        # instantaneous values, W
+        self.solar = 0
+        self.load = 0
+        self.charge = 0     # +ve charging, -ve discharging
+        self.out = 0
+        self.grid = 0       # +ve export
+
+        # accumulated energy, Wh
+        self.totals = Counter()
+
+    # the view used by the Controller
+
+    p_pv1 = property(lambda self: self.solar // 2)
+    p_pv2 = property(lambda self: self.solar - self.solar // 2)
+    p_inverter_out = property(lambda self: self.out)
+    p_grid_out = property(lambda self: self.grid)
+    p_battery = property(lambda self: -self.charge)
+    battery_percent = property(lambda self: int(self.soc))
+    temp_inverter_heatsink = property(lambda self: 30 + self.out / 250)
+    battery_pause_mode = property(lambda self: self.hr[HR_PAUSE_MODE])
+    battery_charge_limit = property(lambda self: self.hr[HR_CHARGE_LIMIT])
+    battery_discharge_limit = property(lambda self: self.hr[HR_DISCHARGE_LIMIT])
+
+    @property
+    def discharge_slot_1(self):
+        start, end = self.hr[HR_DISCHARGE_SLOT_1_START], self.hr[HR_DISCHARGE_SLOT_1_END]
+        return TimeSlot(hhmm(start), hhmm(end)) if start != end else None
+
+    NAMES = {
+        'battery_charge_limit': HR_CHARGE_LIMIT,
+        'battery_discharge_limit': HR_DISCHARGE_LIMIT,
+        'battery_pause_mode': HR_PAUSE_MODE,
+    }
+
+    def write_named_register(self, name, value):
+        self.hr[self.NAMES[name]] = int(value)
+
+    # physics
+
+    def solar_at(self, now):
+        if self.profile is not None:
+            return self.profile.at(now, 'solar')
+        hour = now.hour + now.minute / 60 + now.second / 3600
+        # roughly 0530 to 2030, peaking at 1300
+        x = (hour - 13) / 7.5
+        clear = self.peak * math.cos(x * math.pi / 2) ** 1.5 if abs(x) < 1 else 0
+        if self.cloud:
+            # slowly-varying random cloud cover
+            self.cloudiness += self.random.uniform(-0.1, 0.1)
+            self.cloudiness = min(1.0, max(1 - self.cloud, self.cloudiness))
+        return int(clear * self.cloudiness)
+
+    def load_at(self, now):
+        if self.profile is not None:
+            return self.profile.at(now, 'load')
+        hour = now.hour
+        load = 300
+        if 7 <= hour < 8 or 17 <= hour < 19:
+            load += 1500
+        return load
+
+    def advance(self, now, dt):
+        """run the model forward dt seconds, ending at now"""
+        self.solar = self.solar_at(now)
+        self.load = self.load_at(now)
+        mode = self.hr[HR_PAUSE_MODE]
+        pause = self.hr[HR_PAUSE_SLOT_START], self.hr[HR_PAUSE_SLOT_END]
+        in_pause = now.time() in TimeSlot(hhmm(pause[0]), hhmm(pause[1]))
+        charge_paused = in_pause and mode in (1, 3)
+        discharge_paused = in_pause and mode in (2, 3)
+
+        cp = self.hr[HR_CHARGE_LIMIT]
+        dp = self.hr[HR_DISCHARGE_LIMIT]
+        charge_cap = 0 if charge_paused or self.soc >= 100 else max(cp, 1) * STEP_W + CHARGE_OFFSET
+        discharge_cap = 0 if discharge_paused or self.soc <= RESERVE else (dp * STEP_W if dp else 55)
+
+        slot = self.discharge_slot_1
+        if slot is not None and self.hr[HR_ENABLE_DISCHARGE] and now.time() in slot:
+            # forced discharge
+            charge = -discharge_cap
+        elif self.solar > self.load:
+            charge = min(self.solar - self.load, charge_cap)
+        else:
+            charge = -min(self.load - self.solar, discharge_cap)
+
+        ac = self.solar - charge
+        clipped = max(0, ac - AC_LIMIT)
+        self.out = ac - clipped
+        self.charge = charge
+        self.grid = self.out - self.load
+
+        hours = dt / 3600
+        self.soc = min(100.0, max(0.0, self.soc + charge * hours / CAPACITY * 100))
+        self.totals['solar'] += self.solar * hours
+        self.totals['clipped'] += clipped * hours
+        self.totals['charged'] += max(0, charge) * hours
+        self.totals['discharged'] += max(0, -charge) * hours
+        self.totals['export'] += max(0, self.grid) * hours
+        self.totals['import'] += max(0, -self.grid) * hours
+
+    # registers
+
+    def input_registers(self):
+        ir = [0] * 60
+        ir[IR_P_PV1] = self.p_pv1
+        ir[IR_P_PV2] = self.p_pv2
+        ir[IR_P_INVERTER_OUT] = int(self.out)
+        ir[IR_P_GRID_OUT] = int(self.grid) & 0xffff
+        ir[IR_TEMP_HEATSINK] = int(self.temp_inverter_heatsink * 10)
+        ir[IR_P_BATTERY] = int(self.p_battery) & 0xffff
+        ir[IR_BATTERY_PERCENT] = int(self.soc)
+        return ir
+
+    def holding_registers(self, base, count):
+        return [self.hr.get(reg, 0) for reg in range(base, base + count)]
+
+class Profile:
+    """solar and load through a recorded day, linearly interpolated"""
+
+    def __init__(self, times, solar, load):
+        # times are seconds since midnight, ascending
+        self.times = times
+        self.values = {'solar': solar, 'load': load}
+
+    def at(self, now, name):
+        t = now.hour * 3600 + now.minute * 60 + now.second
+        times, values = self.times, self.values[name]
+        i = bisect(times, t)
+        if i == 0:
+            return int(values[0])
+        if i == len(times):
+            return int(values[-1])
+        t0, t1 = times[i-1], times[i]
+        v0, v1 = values[i-1], values[i]
+        return int(v0 + (v1 - v0) * (t - t0) / (t1 - t0)) if t1 > t0 else int(v1)
+
+    @staticmethod
+    def load(filename):
+        """read a recorded day, from the data-points archive or
+        the monitor's samples file"""
+        if filename.endswith('.gedp'):
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin'))
+            from archive import DataPointArchive
+            archive = DataPointArchive(os.path.dirname(filename) or '.')
+            day = os.path.basename(filename)[:-len('.gedp')]
+            columns = archive.load(day)
+            solar, load = columns['solar_power'], columns['consumption_power']
+        else:
+            import ringbuf
+            columns = ringbuf.load(filename)
+            solar = columns['solar']
+            # what came out of the inverter, less what was exported
+            load = [g - e for g, e in zip(columns['gen'], columns['export'])]
+        times = []
+        for t in columns['time']:
+            d = datetime.fromtimestamp(t)
+            times.append(d.hour * 3600 + d.minute * 60 + d.second)
+        return Profile(times, list(solar), list(load))
+
+# The givenergy modbus framing. Everything is wrapped in a
+# "transparent" message:
+#   tid 0x5959, pid 0x0001, length, uid 0x01, fid 0x02,
+#   data adapter serial (10), padding (8), then the modbus pdu:
+#   slave address, function code, ... , crc
+# Responses carry the inverter serial number after the function code.
+
+ADAPTER_SERIAL = b'WF0000SIM0'
+INVERTER_SERIAL = b'SA0000SIM0'
+PADDING = struct.pack('>Q', 8)
+
+def crc16(data):
+    crc = 0xffff
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+    return crc
+
+def frame(pdu):
+    pdu += struct.pack('<H', crc16(pdu))
+    body = b'\x01\x02' + ADAPTER_SERIAL + PADDING + pdu
+    return struct.pack('>HHH', 0x5959, 0x0001, len(body)) + body
+
+class SimClock:
+    """simulated time, running at speed x real-time from start"""
+
+    def __init__(self, start, speed):
+        self.start = start
+        self.speed = speed
+        self.t0 = time.monotonic()
+
+    def __call__(self):
+        return self.start + timedelta(seconds=(time.monotonic() - self.t0) * self.speed)
+
+async def serve(model, port, speed, start):
+    clock = SimClock(start, speed)
+    writes = Counter()
+
+    async def physics():
+        last = clock()
+        while True:
+            await asyncio.sleep(1)
+            now = clock()
+            model.advance(now, (now - last).total_seconds())
+            last = now
+
+    async def connection(reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(6)
+                tid, pid, length = struct.unpack('>HHH', header)
+                body = await reader.readexactly(length)
+                if body[1] != 2:
+                    continue    # heartbeat or similar
+                pdu = body[2 + 10 + 8:]
+                slave, function, reg, value = struct.unpack('>BBHH', pdu[:6])
+                if function == 4:
+                    ir = model.input_registers()
+                    values = [ir[r] if r < len(ir) else 0 for r in range(reg, reg + value)]
+                    reply = struct.pack('>BB', slave, function) + INVERTER_SERIAL + \
+                        struct.pack('>HH', reg, value) + struct.pack(f'>{value}H', *values)
+                elif function == 3:
+                    values = model.holding_registers(reg, value)
+                    reply = struct.pack('>BB', slave, function) + INVERTER_SERIAL + \
+                        struct.pack('>HH', reg, value) + struct.pack(f'>{value}H', *values)
+                elif function == 6:
+                    model.hr[reg] = value
+                    writes[reg] += 1
+                    print(clock().strftime('%H:%M:%S'), f'write HR({reg}) = {value}')
+                    reply = struct.pack('>BB', slave, function) + INVERTER_SERIAL + struct.pack('>HH', reg, value)
+                else:
+                    continue
+                writer.write(frame(reply))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    asyncio.create_task(physics())
+    server = await asyncio.start_server(connection, port=port)
+    print(f'simulated inverter listening on port {port}, at {speed}x real-time')
+    async with server:
+        await server.serve_forever()
+
+class SimPlant:
+    """just enough of a Plant for the Controller"""
+
+    def __init__(self, model, clock):
+        self.inverter = model
+        self.dpchanged = None
+        self.clock = clock
+
+def day(model, start, end, params=None):
+    """Run the controller over a simulated day. Returns a summary dict."""
+    from monitor import Controller, PARAMS
+
+    now = start
+    plant = SimPlant(model, lambda: now)
+    controller = Controller(plant, params or PARAMS)
+    writes = Counter()
+    cycles = 0
+    failures = []
+    step_time = 0.0
+    while now < end:
+        t0 = time.perf_counter()
+        try:
+            decisions, delay = controller.step(now)
+        except AssertionError as e:
+            # one of the controller's sanity checks tripped - which is
+            # exactly the sort of thing we want to find out about
+            failures.append((now, e))
+            decisions, delay = [], 30
+        step_time += time.perf_counter() - t0
+        cycles += 1
+        for name, value in decisions:
+            model.write_named_register(name, value)
+            writes[name] += 1
+
+        # advance the model in small steps until the next cycle
+        target = now + timedelta(seconds=delay)
+        while now < target:
+            dt = min(10.0, (target - now).total_seconds())
+            now += timedelta(seconds=dt)
+            model.advance(now, dt)
+
+    return {
+        'cycles': cycles,
+        'failures': failures,
+        'writes': writes,
+        'step_us': step_time / max(cycles, 1) * 1e6,
+        'totals': model.totals,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='simulated inverter')
+    sub = parser.add_subparsers(dest='mode', required=True)
+    s = sub.add_parser('serve', help='serve modbus connections')
+    s.add_argument('--port', type=int, default=8899)
+    s.add_argument('--speed', type=float, default=1.0, help='simulated time runs this much faster')
+    d = sub.add_parser('day', help='run the controller over a simulated day')
+    for p in (s, d):
+        p.add_argument('--peak', type=float, default=6400, help='peak solar, W')
+        p.add_argument('--cloud', type=float, default=0.0, help='max fraction of solar lost to cloud')
+        p.add_argument('--seed', type=int)
+        p.add_argument('--soc', type=float, default=20)
+        p.add_argument('--profile', help='recorded day to take solar and load from')
+    args = parser.parse_args()
+
+    profile = Profile.load(args.profile) if args.profile else None
+    model = InverterModel(args.peak, args.cloud, args.seed, args.soc, profile)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    if args.mode == 'serve':
+        asyncio.run(serve(model, args.port, args.speed, datetime.now()))
+    else:
+        result = day(model, today.replace(hour=5, minute=30), today.replace(hour=20))
+        print(f"{result['cycles']} cycles, {result['step_us']:.0f}us per control step")
+        for when, e in result['failures']:
+            print(f"{when.strftime('%H:%M:%S')} controller assertion failed {e}")
+        for name, count in sorted(result['writes'].items()):
+            print(f'{name:30s} {count:5d}')
+        for name, wh in sorted(result['totals'].items()):
+            print(f'{name:12s} {wh/1000:6.2f} kWh')
+
+if __name__ == "__main__":
+    main()
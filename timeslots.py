@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# An index over the inverter's timeslots (charge slots 1-10, discharge
+# slots 1-10 and the pause timer), for the monitor.
+#
+# Slot times are set in whole minutes, so the day is split at every slot
+# boundary into intervals within which the set of active slots doesn't
+# change, each knowing when the next change is, and a table maps each
+# minute of the day to its interval. Then "which slots are active now"
+# and "when is the next boundary" are a couple of lookups, however many
+# slots are set, and midnight-wrapping slots need no special cases. The
+# index is only rebuilt when the slot registers change (SLOT_REGISTERS).
+#
+# Note that slots 3-10 only exist on newer models, and are only seen if
+# the monitor refreshes the block they're in.
+#
+#  timeslots.py HH:MM-HH:MM ...
+# prints the intervals for some slots, as a quick check.
+
+from array import array
+from datetime import datetime, timedelta
+import sys
+
+MINUTES = 24 * 60
+
+# holding registers with slot times in them: charge slot 2, discharge
+# slots 2 and 1, charge slot 1, the pause timer, and the block with
+# slots 3-10 on models which have them
+SLOT_REGISTERS = frozenset({31, 32, 44, 45, 56, 57, 94, 95, 319, 320} | set(range(240, 300)))
+
+# index name: attribute of the library's Inverter
+SLOT_ATTRIBUTES = (
+    [(f'charge_{n}', f'charge_slot_{n}') for n in range(1, 11)] +
+    [(f'discharge_{n}', f'discharge_slot_{n}') for n in range(1, 11)] +
+    [('pause', 'battery_pause_slot_1')]
+)
+
+def minute(t):
+    return t.hour * 60 + t.minute
+
+class SlotIndex:
+    """which slots are active at each point of the day"""
+
+    def __init__(self, slots):
+        """slots is a dict of name: (start, end) times, or anything with
+        start and end attributes (eg a TimeSlot). Slots which start and
+        end at the same time are disabled, and left out."""
+        self.slots = {}
+        for name, slot in slots.items():
+            if slot is None:
+                continue
+            start, end = slot if isinstance(slot, tuple) else (slot.start, slot.end)
+            start, end = minute(start), minute(end)
+            if start != end:
+                self.slots[name] = (start, end)
+
+        edges = sorted({0} | {m for s, e in self.slots.values() for m in (s, e)})
+        active = [frozenset(name for name, (s, e) in self.slots.items()
+                            if (s <= m < e if s < e else (m >= s or m < e)))
+                  for m in edges]
+        # intervals as (start minute, minute of the next change, active
+        # slots), where the next change may be in the next day (> MINUTES).
+        # Midnight is always an edge, but only a change if a slot starts
+        # or ends there.
+        self.intervals = []
+        n = len(edges)
+        for i, m in enumerate(edges):
+            change = None
+            for j in range(i + 1, i + n + 1):
+                if active[j % n] != active[i]:
+                    change = edges[j % n] + MINUTES * (j // n)
+                    break
+            self.intervals.append((m, change, active[i]))
+
+        self.lookup = array('B' if n < 256 else 'H', [0]) * MINUTES
+        for i, m in enumerate(edges):
+            end = edges[i + 1] if i + 1 < n else MINUTES
+            for k in range(m, end):
+                self.lookup[k] = i
+
+    @staticmethod
+    def from_inverter(inverter):
+        return SlotIndex({name: getattr(inverter, attr, None) for name, attr in SLOT_ATTRIBUTES})
+
+    def _interval(self, now):
+        """the interval now is in, and the minute of day"""
+        m = minute(now)
+        return self.intervals[self.lookup[m]], m
+
+    def active(self, now):
+        """names of the slots active at now"""
+        return self._interval(now)[0][2]
+
+    def next_boundary(self, now):
+        """datetime at which the set of active slots next changes,
+        or None if it never does (eg no slots)"""
+        change = self._interval(now)[0][1]
+        if change is None:
+            return None
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        return midnight + timedelta(minutes=change)
+
+    def remaining(self, name, now):
+        """seconds until slot name ends, or 0 if it isn't active"""
+        if name not in self.active(now):
+            return 0
+        start, end = self.slots[name]
+        m = minute(now)
+        if end <= m:
+            end += MINUTES
+        return (end - m) * 60 - now.second - now.microsecond / 1e6
+
+def main():
+    slots = {}
+    for n, spec in enumerate(sys.argv[1:], 1):
+        start, end = (datetime.strptime(x, '%H:%M').time() for x in spec.split('-'))
+        slots[f'slot_{n}'] = (start, end)
+    index = SlotIndex(slots)
+    for start, change, active in index.intervals:
+        until = '' if change is None else f' until {change // 60 % 24:02d}:{change % 60:02d}'
+        print(f'{start // 60:02d}:{start % 60:02d} {" ".join(sorted(active)) or "-"}{until}')
+
+if __name__ == "__main__":
+    main()
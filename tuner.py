@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Tune the constants of the monitor's control law (monitor.Params) by
+# sweeping over combinations of them, running each against the
+# simulated inverter (siminverter.py) over one or more days.
+#
+#  tuner.py [--grid name=v1,v2,...]... [--jobs N] [--top N] [day ...]
+#
+# Each day is a recorded day (a .gedp file from the data-points archive,
+# or a samples.<date>.bin from the monitor) to take solar and load from.
+# With none given, it uses a clear day and a cloudy one from the model.
+#
+# Each --grid replaces the default set of values tried for one of the
+# parameters; the sweep is over every combination. Combinations are
+# spread over a pool of processes (default: one per cpu).
+#
+# For each combination it reports the energy clipped, the number of
+# writes to the inverter, and the battery throughput, sorted by clipped
+# energy then writes. The current settings are marked with a *.
+
+import argparse
+import contextlib
+from datetime import datetime
+import itertools
+import multiprocessing
+import os
+import time
+
+from monitor import Params, PARAMS
+from siminverter import InverterModel, Profile, day
+
+# values to try for each parameter, unless overridden by --grid
+GRID = {
+    'factor': (.5, .75, .9),
+    'decay': (.9, .95, .98),
+    'high': (4700, 4800, 4900),
+    'clip': (4900,),
+    'target': (4300, 4500, 4700),
+    'step': (97.5,),
+    'delay_base': (5555,),
+    'delay_slope': (12, 18.5, 25),
+}
+
+# used when no recorded days are given: (peak, cloud, seed)
+MODEL_DAYS = ((6400, 0.0, None), (7000, 0.4, 1))
+
+def evaluate(job):
+    """run one set of parameters over all the days. Returns
+    (params, clipped Wh, writes, throughput Wh, failures)"""
+    params, days = job
+    clipped = throughput = 0.0
+    writes = failures = 0
+    # the controller prints as it goes
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for profile, peak, cloud, seed in days:
+            model = InverterModel(peak, cloud, seed, 20, profile)
+            today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            result = day(model, today.replace(hour=5, minute=30), today.replace(hour=20), params)
+            totals = result['totals']
+            clipped += totals['clipped']
+            throughput += totals['charged'] + totals['discharged']
+            writes += sum(result['writes'].values())
+            failures += len(result['failures'])
+    return params, clipped, writes, throughput, failures
+
+def parse_grid(specs):
+    grid = dict(GRID)
+    for spec in specs:
+        name, _, values = spec.partition('=')
+        if name not in Params._fields:
+            raise SystemExit(f'unknown parameter {name}: should be one of {", ".join(Params._fields)}')
+        grid[name] = tuple(float(v) for v in values.split(','))
+    return grid
+
+def main():
+    parser = argparse.ArgumentParser(description='sweep the control law parameters against the simulated inverter')
+    parser.add_argument('days', nargs='*', help='recorded days (.gedp or samples .bin)')
+    parser.add_argument('--grid', action='append', default=[], metavar='NAME=V1,V2,...',
+                        help='values to try for a parameter')
+    parser.add_argument('--jobs', type=int, help='worker processes (default: cpu count)')
+    parser.add_argument('--top', type=int, default=20, help='how many results to show')
+    args = parser.parse_args()
+
+    if args.days:
+        days = [(Profile.load(f), 0, 0.0, None) for f in args.days]
+    else:
+        days = [(None, peak, cloud, seed) for peak, cloud, seed in MODEL_DAYS]
+
+    grid = parse_grid(args.grid)
+    combinations = [Params(*values) for values in itertools.product(*(grid[name] for name in Params._fields))]
+    if PARAMS not in combinations:
+        combinations.append(PARAMS)
+    print(f'{len(combinations)} combinations over {len(days)} days')
+
+    t0 = time.perf_counter()
+    with multiprocessing.Pool(args.jobs) as pool:
+        results = pool.map(evaluate, [(params, days) for params in combinations],
+                           chunksize=max(1, len(combinations) // (4 * (args.jobs or os.cpu_count() or 1))))
+    print(f'took {time.perf_counter() - t0:.1f}s')
+
+    results.sort(key=lambda r: (r[1], r[2]))
+    shown = results[:args.top]
+    shown += [r for r in results if r[0] == PARAMS and r not in shown]
+    names = ' '.join(f'{name:>11s}' for name in Params._fields)
+    print(f'  {names} {"clip kWh":>9s} {"writes":>6s} {"thru kWh":>9s} {"fails":>5s}')
+    for params, clipped, writes, throughput, failures in shown:
+        values = ' '.join(f'{v:11g}' for v in params)
+        mark = '*' if params == PARAMS else ' '
+        print(f'{mark} {values} {clipped/1000:9.2f} {writes:6d} {throughput/1000:9.2f} {failures:5d}')
+
+if __name__ == "__main__":
+    main()